@@ -0,0 +1,192 @@
+"""Local stand-ins for the alt worker, the RapidAPI /url endpoint and the TeraBox CDN
+
+Share links name their own content: https://terabox.com/s/1b-<tag>-<files>-<size> is a
+share of <files> files of <size> bytes each. Run it on its own so its CPU and memory stay
+out of the bot's numbers:
+
+    python -m bench.fake_services --port 8090 --bandwidth 10
+"""
+import io
+import time
+import random
+import asyncio
+import argparse
+from aiohttp import web
+from PIL import Image
+
+BLOCK_SIZE = 1024 * 1024  # File bodies repeat one block of seeded random bytes
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_share(link):
+    """(tag, files, size) of a bench share link or share id, None if it is not one"""
+    share = link.rstrip("/").rsplit("/", 1)[-1]
+    parts = share.split("-")
+    if len(parts) != 4 or parts[0] != "1b":
+        return None
+    try:
+        return parts[1], int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+
+
+def share_link(tag, files, size):
+    return f"https://terabox.com/s/1b-{tag}-{files}-{size}"
+
+
+class FakeServices:
+    """aiohttp application serving the resolver APIs and the files they point at"""
+
+    def __init__(self, api_latency=0.2, cdn_latency=0.05, bandwidth=0, ranges=True,
+                 alt_fail=False, bad_keys=(), seed=0):
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.bandwidth = bandwidth  # Bytes per second per connection, 0 = unlimited
+        self.ranges = ranges
+        self.alt_fail = alt_fail
+        self.bad_keys = set(bad_keys)
+        self.block = random.Random(seed).randbytes(BLOCK_SIZE)
+        self.base_url = None
+        thumb = io.BytesIO()
+        Image.new("RGB", (480, 270), (40, 90, 160)).save(thumb, "JPEG")
+        self.thumb = thumb.getvalue()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/alt", self.alt)
+        app.router.add_get("/url", self.rapidapi)
+        app.router.add_get("/cdn/{share}/{index}", self.cdn)
+        app.router.add_get("/thumb/{share}/{index}.jpg", self.thumbnail)
+        return app
+
+    def entry(self, share, index, size):
+        name = f"{share}_{index}.mp4"
+        return {
+            "file_name": name,
+            "direct_link": f"{self.base_url}/cdn/{share}/{index}",
+            "link": f"{self.base_url}/cdn/{share}/{index}?mirror=1",
+            "thumbnail": f"{self.base_url}/thumb/{share}/{index}.jpg",
+            "size": f"{size / 1024 / 1024:.2f} MB",
+            "sizebytes": size
+        }
+
+    async def alt(self, request):
+        """The alt worker only handles single-file shares"""
+        await asyncio.sleep(self.api_latency)
+        spec = parse_share(request.query.get("url", ""))
+        if self.alt_fail or not spec or spec[1] != 1:
+            return web.json_response({"error": "unsupported link"})
+        share = request.query["url"].rstrip("/").rsplit("/", 1)[-1]
+        entry = self.entry(share, 0, spec[2])
+        entry["thumb"] = entry.pop("thumbnail")
+        return web.json_response(entry)
+
+    async def rapidapi(self, request):
+        await asyncio.sleep(self.api_latency)
+        if request.headers.get("X-RapidAPI-Key") in self.bad_keys:
+            return web.json_response({"message": "Too many requests"}, status=429)
+        spec = parse_share(request.query.get("url", ""))
+        if not spec:
+            return web.json_response({"message": "Invalid link"}, status=400)
+        share = request.query["url"].rstrip("/").rsplit("/", 1)[-1]
+        return web.json_response([self.entry(share, index, spec[2]) for index in range(spec[1])])
+
+    async def thumbnail(self, request):
+        return web.Response(body=self.thumb, content_type="image/jpeg")
+
+    async def cdn(self, request):
+        spec = parse_share(request.match_info["share"])
+        if not spec:
+            raise web.HTTPNotFound()
+        size = spec[2]
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if self.ranges and range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size or start > end:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+
+        await asyncio.sleep(self.cdn_latency)
+        response = web.StreamResponse(status=status)
+        response.content_type = "video/mp4"
+        response.content_length = end - start + 1
+        if self.ranges:
+            response.headers["Accept-Ranges"] = "bytes"
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+
+        block = memoryview(self.block)
+        position = start
+        sent = 0
+        began = time.monotonic()
+        try:
+            while position <= end:
+                offset = position % BLOCK_SIZE
+                length = min(CHUNK_SIZE, BLOCK_SIZE - offset, end - position + 1)
+                await response.write(block[offset:offset + length])
+                position += length
+                sent += length
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.monotonic() - began)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # The client stopped reading, as the range probe does without Range support
+        return response
+
+
+async def serve(services, host="127.0.0.1", port=0):
+    """Start the services; returns the runner, services.base_url is set to where they listen"""
+    runner = web.AppRunner(services.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_host, bound_port = runner.addresses[0][:2]
+    services.base_url = f"http://{bound_host}:{bound_port}"
+    return runner
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--api-latency", type=float, default=0.2, help="seconds before an API answers")
+    parser.add_argument("--cdn-latency", type=float, default=0.05, help="seconds before the first byte of a file")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s per CDN connection, 0 = unlimited")
+    parser.add_argument("--no-ranges", action="store_true", help="ignore Range headers like some CDN nodes do")
+    parser.add_argument("--alt-fail", action="store_true", help="make the alt worker fail every link")
+    parser.add_argument("--bad-key", action="append", default=[], help="RapidAPI key answered with 429")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    services = FakeServices(
+        api_latency=args.api_latency,
+        cdn_latency=args.cdn_latency,
+        bandwidth=int(args.bandwidth * 1024 * 1024),
+        ranges=not args.no_ranges,
+        alt_fail=args.alt_fail,
+        bad_keys=args.bad_key,
+        seed=args.seed
+    )
+    runner = await serve(services, args.host, args.port)
+    # bench.run waits for this line
+    print(f"listening on {services.base_url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,183 @@
+"""A stand-in for the TelegramClient the bot talks to
+
+It records every call, pushes uploaded bytes through one shared uplink of fixed bandwidth
+and puts Telegram-like rate limits on messages and edits.
+"""
+import os
+import time
+import asyncio
+import itertools
+from collections import Counter
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.types import Document, InputFile, InputFileBig, DocumentAttributeFilename
+
+
+class Uplink:
+    """Transfers queue behind each other on one link of bandwidth bytes per second"""
+
+    def __init__(self, bandwidth=0):
+        self.bandwidth = bandwidth
+        self.bytes = 0
+        self._free_at = 0.0
+
+    async def transfer(self, size):
+        self.bytes += size
+        if not self.bandwidth:
+            return
+        now = time.monotonic()
+        self._free_at = max(now, self._free_at) + size / self.bandwidth
+        await asyncio.sleep(self._free_at - now)
+
+
+class RateLimit:
+    """Token bucket: burst requests at once, then rate per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id, message_id, text=None, document=None):
+        self.client = client
+        self.chat_id = chat_id
+        self.id = message_id
+        self.text = text
+        self.document = document
+        self.photo = None
+        self.media = document
+
+    async def edit(self, text=None, **kwargs):
+        return await self.client.edit_message(self.chat_id, self.id, text, **kwargs)
+
+    async def delete(self):
+        await self.client.delete_messages(self.chat_id, [self.id])
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"bench{user_id}"
+        self.username = None
+
+
+class FakeEvent:
+    """The parts of a NewMessage event the bot's handlers use"""
+
+    def __init__(self, client, user_id, text):
+        self.client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.raw_text = text
+        self.id = next(client.ids)
+        self.is_reply = False
+
+    async def get_sender(self):
+        return FakeUser(self.sender_id)
+
+    async def reply(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.id, **kwargs)
+
+
+class FakeTelegram:
+    """Records calls, simulates upload bandwidth and answers messages past the rate limits with a FloodWait
+
+    Messages and edits in one chat may burst chat_burst, then chat_rate per second; the
+    whole bot gets global_rate per second. Like TelegramClient, a FloodWait no longer than
+    flood_sleep_threshold is slept through and the request retried, a longer one is raised.
+    """
+
+    def __init__(self, upload_bandwidth=0, send_latency=0.05, chat_rate=1, chat_burst=5, global_rate=30,
+                 flood_seconds=5, flood_sleep_threshold=60):
+        self.uplink = Uplink(upload_bandwidth)
+        self.send_latency = send_latency
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.flood_seconds = flood_seconds
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.calls = Counter()
+        self.flood_waits = Counter()
+        self.ids = itertools.count(1000)
+        self._chat_limits = {}
+        self._global_limit = RateLimit(global_rate, global_rate)
+
+    def _document(self, name, size):
+        return Document(
+            id=next(self.ids), access_hash=0, file_reference=b"bench", date=None,
+            mime_type="application/octet-stream", size=size, dc_id=1,
+            attributes=[DocumentAttributeFilename(name)]
+        )
+
+    async def _rate_limit(self, method, chat_id):
+        chat_limit = self._chat_limits.get(chat_id)
+        if chat_limit is None:
+            chat_limit = self._chat_limits[chat_id] = RateLimit(self.chat_rate, self.chat_burst)
+        while not (chat_limit.take() and self._global_limit.take()):
+            if self.flood_seconds > self.flood_sleep_threshold:
+                self.flood_waits[f"{method} raised"] += 1
+                raise FloodWaitError(request=None, capture=self.flood_seconds)
+            self.flood_waits[f"{method} slept"] += 1
+            await asyncio.sleep(self.flood_seconds)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls["send_message"] += 1
+        await self._rate_limit("send_message", chat_id)
+        await asyncio.sleep(self.send_latency)
+        return FakeMessage(self, chat_id, next(self.ids), text)
+
+    async def edit_message(self, chat_id, message_id, text=None, **kwargs):
+        self.calls["edit_message"] += 1
+        await self._rate_limit("edit_message", chat_id)
+        await asyncio.sleep(self.send_latency)
+        return FakeMessage(self, chat_id, message_id, text)
+
+    async def send_file(self, chat_id, file, caption=None, **kwargs):
+        self.calls["send_file"] += 1
+        if isinstance(file, str):
+            # send_file uploading from disk itself
+            size = os.path.getsize(file)
+            name = os.path.basename(file)
+            await self.uplink.transfer(size)
+        elif isinstance(file, (InputFile, InputFileBig)):
+            size, name = 0, file.name
+        else:
+            # A cached media reference
+            size, name = 0, "cached"
+        await asyncio.sleep(self.send_latency)
+        return FakeMessage(self, chat_id, next(self.ids), caption, document=self._document(name, size))
+
+    async def forward_messages(self, entity, messages, **kwargs):
+        self.calls["forward_messages"] += 1
+        await asyncio.sleep(self.send_latency)
+        return FakeMessage(self, entity, next(self.ids), document=getattr(messages, "document", None))
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        self.calls["delete_messages"] += 1
+
+    async def get_messages(self, chat_id, ids=None, **kwargs):
+        self.calls["get_messages"] += 1
+        return None
+
+    async def get_permissions(self, chat_id, user_id):
+        self.calls["get_permissions"] += 1
+        return True
+
+    async def __call__(self, request):
+        """Raw requests: only file part uploads are expected"""
+        self.calls[type(request).__name__] += 1
+        if isinstance(request, (SaveFilePartRequest, SaveBigFilePartRequest)):
+            await self.uplink.transfer(len(request.bytes))
+            return True
+        raise NotImplementedError(type(request).__name__)
@@ -0,0 +1,288 @@
+"""Run one load scenario through bot.py with TeraBox, the resolver APIs, MongoDB and Telegram replaced by local fakes
+
+    python -m bench.run single
+    python -m bench.run folder --output before.json
+    python -m bench.run users --users 20 --env DOWNLOAD_SEGMENTS=8 --compare before.json
+
+The JSON report goes to stdout. Each run should be a fresh process, so peak RSS and CPU
+time belong to that scenario alone; the fake HTTP services run in a subprocess of their own.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import subprocess
+from collections import Counter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+# users, files per user and file size of each scenario; the command line overrides them
+SCENARIOS = {
+    "single": {"users": 1, "files": 1, "size_mb": 256},
+    "folder": {"users": 1, "files": 30, "size_mb": 8},
+    "users": {"users": 10, "files": 3, "size_mb": 16}
+}
+# Metrics --compare prints, as paths into the report
+COMPARED = [
+    ("wall_seconds",), ("throughput_mb_s",), ("job_seconds", "p50"), ("job_seconds", "p95"),
+    ("job_seconds", "p99"), ("first_file_seconds", "p50"), ("download_mb_s", "p50"),
+    ("peak_rss_mb",), ("cpu_seconds",)
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, help="users sending a link at once")
+    parser.add_argument("--files", type=int, help="files in each user's share")
+    parser.add_argument("--size-mb", type=float, help="size of every file")
+    parser.add_argument("--arrival", type=float, default=0, help="seconds between two users' links")
+    parser.add_argument("--api-latency", type=float, default=0.2, help="seconds before a resolver API answers")
+    parser.add_argument("--cdn-latency", type=float, default=0.05, help="seconds before the first byte of a file")
+    parser.add_argument("--cdn-bandwidth", type=float, default=10, help="MB/s per CDN connection, 0 = unlimited")
+    parser.add_argument("--no-ranges", action="store_true", help="CDN ignores Range headers")
+    parser.add_argument("--alt-fail", action="store_true", help="alt worker fails every link")
+    parser.add_argument("--bad-keys", type=int, default=0, help="RapidAPI keys answered with 429, of two")
+    parser.add_argument("--upload-bandwidth", type=float, default=25, help="MB/s of the uplink to Telegram, 0 = unlimited")
+    parser.add_argument("--chat-rate", type=float, default=1, help="messages and edits per second per chat after a burst of 5")
+    parser.add_argument("--flood-seconds", type=int, default=5, help="wait of a simulated FloodWait, above 60 it is raised")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="bot setting for this run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before unfinished jobs are cancelled")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--compare", help="report of an earlier run to print changes against")
+    args = parser.parse_args(argv)
+    for name, value in SCENARIOS[args.scenario].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    return args
+
+
+def configure_environment(args, scratch_dir):
+    """bot.py reads its settings at import, so this runs before it is imported"""
+    os.environ.update(
+        TELEGRAM_TOKEN="bench",
+        API_ID="1",
+        API_HASH="bench",
+        CHANNEL_ID="-1001",
+        OWNER_ID="1",
+        MIRROR_CHANNEL_ID="-1002",
+        LOG_CHANNEL_ID="",
+        LINK_CHANNEL_ID="",
+        MONGO_URI="mongodb://bench",
+        API_KEYS="bench-key-1,bench-key-2",
+        SCRATCH_DIR=os.path.join(scratch_dir, "downloads"),
+        THUMB_CACHE_DIR=os.path.join(scratch_dir, "thumbs")
+    )
+    for setting in args.env:
+        name, _, value = setting.partition("=")
+        os.environ[name] = value
+
+
+async def start_services(args):
+    command = [
+        sys.executable, "-m", "bench.fake_services",
+        "--api-latency", str(args.api_latency),
+        "--cdn-latency", str(args.cdn_latency),
+        "--bandwidth", str(args.cdn_bandwidth),
+        "--seed", str(args.seed)
+    ]
+    if args.no_ranges:
+        command.append("--no-ranges")
+    if args.alt_fail:
+        command.append("--alt-fail")
+    for index in range(args.bad_keys):
+        command += ["--bad-key", f"bench-key-{index + 1}"]
+    process = await asyncio.create_subprocess_exec(*command, cwd=REPO_DIR, stdout=asyncio.subprocess.PIPE)
+    line = await asyncio.wait_for(process.stdout.readline(), timeout=30)
+    if not line.startswith(b"listening on "):
+        process.kill()
+        raise RuntimeError("fake services did not start")
+    return process, line.decode().split()[-1]
+
+
+def summarize(values):
+    from tracing import percentile
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_report(args, traces, client, dispatcher, wall_seconds, timed_out):
+    delivered_phases = ("upload", "send_cached")
+    phases = {}
+    first_file = []
+    download_rates = []
+    files_delivered = 0
+    for trace in traces:
+        finished = []
+        for span in trace["spans"]:
+            phases.setdefault(span["phase"], []).append(span["duration"])
+            if span["phase"] in delivered_phases and "error" not in span:
+                files_delivered += 1
+                finished.append(span["offset"] + span["duration"])
+            if span["phase"] == "download" and span.get("size") and span["duration"] > 0:
+                download_rates.append(span["size"] / span["duration"] / MB)
+        if finished:
+            first_file.append(min(finished))
+
+    bytes_downloaded = sum(trace["bytes"] for trace in traces)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    config = {name: value for name, value in vars(args).items() if name not in ("output", "compare", "log_level")}
+    return {
+        "scenario": args.scenario,
+        "config": config,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "timed_out": timed_out,
+        "wall_seconds": round(wall_seconds, 3),
+        "jobs": len(traces),
+        "job_states": dict(Counter(trace["state"] for trace in traces)),
+        "files_expected": args.users * args.files,
+        "files_delivered": files_delivered,
+        "bytes_downloaded": bytes_downloaded,
+        "throughput_mb_s": round(bytes_downloaded / MB / wall_seconds, 3) if wall_seconds else 0,
+        "job_seconds": summarize(trace["duration"] for trace in traces),
+        "first_file_seconds": summarize(first_file),
+        "download_mb_s": summarize(download_rates),
+        "phase_seconds": {phase: summarize(durations) for phase, durations in sorted(phases.items())},
+        "telegram": {
+            "calls": dict(client.calls),
+            "flood_waits": dict(client.flood_waits),
+            "uploaded_mb": round(client.uplink.bytes / MB, 3)
+        },
+        "progress_edits": {
+            "sent": dispatcher.sent,
+            "dropped": dispatcher.dropped,
+            "failed": dispatcher.failed,
+            "flood_waits": dispatcher.flood_waits
+        },
+        "peak_rss_mb": round(peak_rss / MB, 1),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3)
+    }
+
+
+def print_comparison(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report["config"]:
+        print("warning: the baseline ran with a different configuration", file=sys.stderr)
+    for path in COMPARED:
+        old, new = baseline, report
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{'.'.join(path):24} {old:>12} -> {new:<12} {change}", file=sys.stderr)
+
+
+async def run_scenario(args):
+    import bot
+    from mongomock_motor import AsyncMongoMockClient
+    from bench.fake_services import share_link
+    from bench.fake_telegram import FakeTelegram, FakeEvent
+
+    logging.getLogger().setLevel(args.log_level)
+    process, base_url = await start_services(args)
+    tasks = []
+    try:
+        bot.motor.motor_asyncio.AsyncIOMotorClient = lambda uri, **kwargs: AsyncMongoMockClient()
+        bot.resolver.alt_api_url = f"{base_url}/alt"
+        bot.resolver.rapidapi_url = f"{base_url}/url"
+        bot.scratch.init()
+        bot.thumbnail_cache.init()
+        await bot.init_database()
+        client = FakeTelegram(
+            upload_bandwidth=int(args.upload_bandwidth * MB),
+            chat_rate=args.chat_rate,
+            flood_seconds=args.flood_seconds
+        )
+        tasks.append(asyncio.create_task(bot.progress_dispatcher.run()))
+        tasks.append(asyncio.create_task(bot.tracer.run()))
+
+        size = int(args.size_mb * MB)
+        started = time.monotonic()
+        for user in range(args.users):
+            link = share_link(f"s{args.seed}u{user}", args.files, size)
+            await bot.handle_message(FakeEvent(client, 10000 + user, link))
+            if args.arrival:
+                await asyncio.sleep(args.arrival)
+
+        timed_out = False
+        while bot.active_downloads:
+            if time.monotonic() - started > args.timeout:
+                timed_out = True
+                for cancel_event in bot.active_downloads.values():
+                    cancel_event.set()
+                while bot.active_downloads:
+                    await asyncio.sleep(0.1)
+                break
+            await asyncio.sleep(0.1)
+        wall_seconds = time.monotonic() - started
+
+        for task in tasks:
+            task.cancel()
+        await bot.tracer.flush()
+        traces = await bot.tracer.collection.find({}).to_list(length=None)
+        return build_report(args, traces, client, bot.progress_dispatcher, wall_seconds, timed_out)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await bot.resolver.close()
+        process.terminate()
+        await process.wait()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scratch_dir = tempfile.mkdtemp(prefix="terabot-bench-")
+    configure_environment(args, scratch_dir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        report = asyncio.run(run_scenario(args))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.compare:
+        print_comparison(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
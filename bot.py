@@ -1,9 +1,8 @@
 import os
 import time
-import requests
 import mimetypes
-import subprocess
 import asyncio
+import signal
 import motor.motor_asyncio
 from dotenv import load_dotenv
 from telethon import TelegramClient, events, Button
@@ -16,9 +15,32 @@ import aiofiles
 import aiohttp
 from aiohttp import ClientTimeout
 import threading
+import uuid
 from collections import deque
 import resource
+from types import SimpleNamespace
+from urllib.parse import urlparse
 from web import keep_alive
+from link_cache import LinkCache, share_id
+from content_cache import ContentCache, file_key, media_reference, input_media
+from resolver import Resolver
+from downloader import probe_ranges, download_segmented, preallocate, DownloadSink
+from uploader import StreamingUpload, SenderPool, upload_parallel
+from pipeline import run_pipeline
+from scheduler import FairScheduler
+from jobs import JobStore
+from deletions import DeletionScheduler
+from progress import ProgressDispatcher
+from media_probe import MediaProber, video_attributes
+from thumbnails import ThumbnailCache
+from broadcast import Broadcaster
+from stats import StatsAggregator
+from slow_queries import SlowQueryLogger
+from known_users import KnownUsers
+from membership import MembershipCache
+from storage import ScratchStorage
+from metrics import observe_phase, watch_event_loop, QUEUE_DEPTH, ACTIVE_SLOTS, UPLOAD_QUEUE_DEPTH, UPLOAD_SLOTS, ACTIVE_DOWNLOADS
+from tracing import Tracer
 
 # Set up loggings
 logging.basicConfig(
@@ -45,7 +67,54 @@ API_KEYS = os.getenv("API_KEYS").split(",") if os.getenv("API_KEYS") else []
 MONGO_URI = os.getenv("MONGO_URI")
 UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", "1200"))
 MAX_FOLDER_FILES = int(os.getenv("MAX_FOLDER_FILES", "30"))  # Max files per folder
-MAX_CONCURRENT_DOWNLOADS = 3  # Max concurrent downloads
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))  # Max concurrent file downloads
+MAX_USER_DOWNLOADS = int(os.getenv("MAX_USER_DOWNLOADS", "1"))  # Max concurrent file downloads per user
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", str(MAX_CONCURRENT_DOWNLOADS)))  # Max concurrent file uploads, they share the sender pool
+MAX_USER_UPLOADS = int(os.getenv("MAX_USER_UPLOADS", str(MAX_USER_DOWNLOADS)))  # Max concurrent file uploads per user
+RESOLVE_CACHE_SIZE = int(os.getenv("RESOLVE_CACHE_SIZE", "1024"))  # In-process resolved links
+RESOLVE_CACHE_TTL = int(os.getenv("RESOLVE_CACHE_TTL", "3600"))  # Upper bound when the dlink has no expiry
+FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", str(30 * 86400)))  # Keep sent media references this long
+RESOLVER_MAX_CONNECTIONS = int(os.getenv("RESOLVER_MAX_CONNECTIONS", "100"))  # Pooled resolver connections
+RESOLVER_MAX_PER_HOST = int(os.getenv("RESOLVER_MAX_PER_HOST", "10"))  # Per API host
+HEDGED_RESOLVE = os.getenv("HEDGED_RESOLVE", "1") == "1"  # Race resolver backends instead of trying them in turn
+RESOLVE_HEDGE_DELAY = float(os.getenv("RESOLVE_HEDGE_DELAY", "3"))  # Seconds before the next backend joins, until latencies are known
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))  # Parallel Range connections per file, 1 disables
+SEGMENT_MIN_SIZE = int(os.getenv("SEGMENT_MIN_SIZE", str(20 * 1024 * 1024)))  # Smaller files use one stream
+SEGMENT_RETRIES = int(os.getenv("SEGMENT_RETRIES", "3"))  # Per segment, resuming where it stopped
+DOWNLOAD_BUFFER_SIZE = int(os.getenv("DOWNLOAD_BUFFER_KB", "1024")) * 1024  # Write size of the download sink
+DOWNLOAD_BUFFERS = int(os.getenv("DOWNLOAD_BUFFERS", "4"))  # Buffers per download, caps its memory at buffers x size
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "0") == "1"  # Upload parts to Telegram while downloading
+STREAM_HEAD_SIZE = int(os.getenv("STREAM_HEAD_SIZE", str(8 * 1024 * 1024)))  # Kept on disk for type, probe and thumbnail
+STREAM_MAX_INFLIGHT = int(os.getenv("STREAM_MAX_INFLIGHT", "8"))  # 512 KB parts in flight per stream
+UPLOAD_CONNECTIONS = int(os.getenv("UPLOAD_CONNECTIONS", "4"))  # Extra MTProto connections for file parts
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "8"))  # Parts in flight per upload, 1 uses send_file alone
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE_KB", "512")) * 1024  # At most 512 KB
+PIPELINE_DOWNLOADS = int(os.getenv("PIPELINE_DOWNLOADS", "1"))  # Files of one folder downloading at once
+PIPELINE_PROBES = int(os.getenv("PIPELINE_PROBES", "1"))  # Files of one folder being probed at once
+PIPELINE_WINDOW = int(os.getenv("PIPELINE_WINDOW", "2"))  # Files of one folder in flight, bounds scratch disk use
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))  # A job unclaimed this long after its last heartbeat is resumed
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))  # Lease renewal and recovery scan
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # Runs of one job before it is marked failed
+DELETE_AFTER = int(os.getenv("DELETE_AFTER", "1800"))  # Seconds before a delivered file is deleted (30 minutes)
+DELETE_POLL_INTERVAL = int(os.getenv("DELETE_POLL_INTERVAL", "30"))  # Longest sleep of the deletion loop
+PROGRESS_CHAT_INTERVAL = float(os.getenv("PROGRESS_CHAT_INTERVAL", "3"))  # Seconds between progress edits in one chat
+PROGRESS_GLOBAL_RATE = float(os.getenv("PROGRESS_GLOBAL_RATE", "20"))  # Progress edits per second for the whole bot
+MEDIA_PROBE_PROCESSES = int(os.getenv("MEDIA_PROBE_PROCESSES", "2"))  # ffprobe/ffmpeg processes at once
+MEDIA_PROBE_TIMEOUT = int(os.getenv("MEDIA_PROBE_TIMEOUT", "30"))  # Seconds before a probe process is killed
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # Messages per second, Telegram allows about 30
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))  # Sends in flight at once
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))  # Users read and checkpointed together
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", "downloads")  # Files go in its terabot subdirectory, emptied at startup; point it at tmpfs or a fast volume
+SCRATCH_BUDGET = int(os.getenv("SCRATCH_BUDGET_MB", "0")) * 1024 * 1024  # Bytes downloads may hold at once, 0 = 90% of free space
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", "thumb_cache")  # API thumbnails, resized for Telegram; kept across restarts
+THUMB_CACHE_SIZE = int(os.getenv("THUMB_CACHE_SIZE_MB", "100")) * 1024 * 1024  # Least recently used thumbnails go first
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "600"))  # Seconds a confirmed channel member is not re-checked
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30"))  # Same for non-members, short so joining takes effect soon
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000"))  # Users remembered
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "100"))  # MongoDB commands slower than this are logged
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "5"))  # Seconds counters stay in memory before being written
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "1"))  # Seconds between event loop lag probes and gauge samples
+TRACE_COLLECTION_SIZE = int(os.getenv("TRACE_COLLECTION_MB", "64")) * 1024 * 1024  # Capped job_traces collection, oldest traces go first
 
 # MongoDB setup
 mongo_client = None
@@ -57,7 +126,41 @@ blocked_users_collection = None
 TERABOX_LINK_REGEX = None
 
 active_downloads = {}
-download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+link_cache = LinkCache(max_entries=RESOLVE_CACHE_SIZE, ttl=RESOLVE_CACHE_TTL)
+content_cache = ContentCache(ttl=FILE_CACHE_TTL)
+resolver = Resolver(
+    api_keys=API_KEYS,
+    rapidapi_host=RAPIDAPI_HOST,
+    max_connections=RESOLVER_MAX_CONNECTIONS,
+    max_per_host=RESOLVER_MAX_PER_HOST,
+    hedged=HEDGED_RESOLVE,
+    hedge_delay=RESOLVE_HEDGE_DELAY
+)
+scheduler = FairScheduler(max_concurrent=MAX_CONCURRENT_DOWNLOADS, per_user=MAX_USER_DOWNLOADS)
+upload_scheduler = FairScheduler(max_concurrent=MAX_CONCURRENT_UPLOADS, per_user=MAX_USER_UPLOADS)
+upload_pool = None
+job_store = JobStore(
+    lease_seconds=JOB_LEASE_SECONDS,
+    heartbeat_interval=JOB_HEARTBEAT_INTERVAL,
+    max_attempts=JOB_MAX_ATTEMPTS
+)
+deletion_scheduler = DeletionScheduler(poll_interval=DELETE_POLL_INTERVAL)
+media_prober = MediaProber(max_processes=MEDIA_PROBE_PROCESSES, timeout=MEDIA_PROBE_TIMEOUT)
+thumbnail_cache = ThumbnailCache(cache_dir=THUMB_CACHE_DIR, max_bytes=THUMB_CACHE_SIZE)
+broadcaster = Broadcaster(rate=BROADCAST_RATE, workers=BROADCAST_WORKERS, batch_size=BROADCAST_BATCH_SIZE)
+slow_queries = SlowQueryLogger(threshold_ms=SLOW_QUERY_MS)
+known_users = KnownUsers()
+scratch = ScratchStorage(SCRATCH_DIR, budget=SCRATCH_BUDGET)
+membership_cache = MembershipCache(
+    CHANNEL_ID,
+    positive_ttl=MEMBERSHIP_TTL,
+    negative_ttl=MEMBERSHIP_NEGATIVE_TTL,
+    max_entries=MEMBERSHIP_CACHE_SIZE
+)
+start_image_ref = None  # START_IMAGE as uploaded by the first /start
+stats = StatsAggregator(flush_interval=STATS_FLUSH_INTERVAL)
+tracer = Tracer(collection_size=TRACE_COLLECTION_SIZE)
+progress_dispatcher = ProgressDispatcher(chat_interval=PROGRESS_CHAT_INTERVAL, global_rate=PROGRESS_GLOBAL_RATE)
 
 def progress_bar(percent):
         filled = int(percent // 5)
@@ -71,56 +174,79 @@ def human_size(size_bytes):
         size_bytes /= 1024
     return f"{size_bytes:.2f} TB"
 
-def get_video_dimensions(file_path):
-    try:
-        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", 
-               "-show_entries", "stream=width,height", 
-               "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        width, height = map(int, result.stdout.strip().split("\n"))
-        return width, height
-    except Exception as e:
-        logger.error(f"Error getting video dimensions: {e}")
-        return None, None
+def human_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
 
-def generate_thumbnail(file_path, thumb_path):
-    try:
-        subprocess.run(
-            ["ffmpeg", "-i", file_path, "-ss", "00:00:01.000", "-vframes", "1", thumb_path],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            timeout=10  # Add timeout to prevent hanging
-        )
-        return os.path.exists(thumb_path)
-    except Exception as e:
-        logger.error(f"Error generating thumbnail: {e}")
-        return False
+def clean_filename(filename):
+    filename = re.sub(r'[\\/*?:"<>|]', "_", filename)
+    if '.' not in filename:
+        if "video" in filename.lower():
+            filename += ".mp4"
+        elif "image" in filename.lower() or "photo" in filename.lower():
+            filename += ".jpg"
+        else:
+            filename += ".bin"
+    return filename
+
+SNIFF_SIZE = 8192  # Bytes libmagic needs to recognise a file
+magic_handle = magic.Magic(mime=True)  # libmagic cookies are not thread-safe, share one under a lock
+magic_lock = threading.Lock()
+
+def sniff_file_type(head, content_type, filename):
+    """Work out a MIME type from the API filename, the first bytes and the response Content-Type"""
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type:
+        return mime_type
 
-def detect_file_type(file_path):
-    """Detect file type using both file extension and magic numbers"""
     try:
-        # First try with file extension
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if mime_type:
-            return mime_type
-        
-        # Fallback to magic number detection
-        mime = magic.Magic(mime=True)
-        return mime.from_file(file_path)
+        with magic_lock:
+            mime_type = magic_handle.from_buffer(head[:SNIFF_SIZE])
     except Exception as e:
         logger.error(f"Error detecting file type: {e}")
-        return "application/octet-stream"
+        mime_type = None
+    if mime_type and mime_type not in ("application/octet-stream", "text/plain"):
+        return mime_type
+
+    content_type = content_type.split(';')[0].strip()
+    if content_type and content_type != "application/octet-stream":
+        return content_type
+    return mime_type or "application/octet-stream"
+
+async def ensure_indexes():
+    """Create the indexes the admin commands and broadcasts rely on; safe to repeat"""
+    indexes = [
+        (users_collection, [("download_count", -1)], {}),
+        (blocked_users_collection, [("user_id", 1)], {"unique": True}),
+        (blocked_users_collection, [("blocked_at", -1)], {})
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Index {collection.name}.{keys} error: {e}")
 
 async def init_database():
     """Initialize database connection and collections"""
     global mongo_client, db, users_collection, stats_collection, blocked_users_collection, TERABOX_LINK_REGEX
     
     # Initialize MongoDB connection
-    mongo_client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
+    mongo_client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI, event_listeners=[slow_queries])
     db = mongo_client["terabot"]
     users_collection = db["users"]
     stats_collection = db["stats"]
     blocked_users_collection = db["blocked_users"]
+    await ensure_indexes()
+    await link_cache.init(db)
+    await content_cache.init(db)
+    await job_store.init(db)
+    await deletion_scheduler.init(db)
+    await broadcaster.init(db, users_collection, blocked_users_collection)
     
     # Initialize regex pattern
     TERABOX_LINK_REGEX = re.compile(
@@ -136,23 +262,12 @@ async def init_database():
             "failed_downloads": 0,
             "last_updated": datetime.datetime.now()
         })
-
-async def delete_message_after_delay(client, chat_id, message_id, delay=10):
-    """Delete a message after a specified delay using Telethon"""
-    await asyncio.sleep(delay)
-    try:
-        await client.delete_messages(chat_id, message_id)
-        logger.info(f"Deleted message {message_id} in chat {chat_id} after {delay} seconds")
-    except Exception as e:
-        logger.warning(f"Failed to delete message {message_id} in chat {chat_id}: {e}")
+    await stats.init(stats_collection, users_collection, db["stats_rollups"])
+    await known_users.init(users_collection)
+    await tracer.init(db)
 
 async def check_membership(event):
-    try:
-        await event.client.get_permissions(CHANNEL_ID, event.sender_id)
-        return True
-    except Exception as e:
-        logger.error(f"Membership check error: {e}")
-        return False
+    return await membership_cache.check(event.client, event.sender_id)
 
 def get_caption(section: str, user) -> str:
     if section == "about_bot":
@@ -211,18 +326,11 @@ def get_keyboard(section: str) -> list:
 
 # Modify the start command
 async def start(event):
+    global start_image_ref
     user = await event.get_sender()
-    existing_user = await users_collection.find_one({"_id": user.id})
-    
-    if not existing_user:
-        await users_collection.insert_one({
-            "_id": user.id,
-            "name": user.first_name,
-            "username": user.username,
-            "join_date": datetime.datetime.now(),
-            "download_count": 0
-        })
-        await stats_collection.update_one({}, {"$inc": {"total_users": 1}})
+
+    async def on_new_user(user):
+        stats.incr("total_users")
         
         if LOG_CHANNEL_ID:
             try:
@@ -233,15 +341,32 @@ async def start(event):
                 )
             except Exception as e:
                 logger.error(f"Error sending new user log: {e}")
+
+    known_users.register(user, on_new_user)
     
     try:
-        await event.client.send_file(
+        # Upload the image once, then re-send it by reference
+        if start_image_ref:
+            try:
+                await event.client.send_file(
+                    event.chat_id,
+                    input_media(start_image_ref),
+                    caption=get_caption("home", user),
+                    parse_mode='html',
+                    buttons=get_keyboard("home")
+                )
+                return
+            except Exception as e:
+                logger.warning(f"Cached start image rejected: {e}")
+                start_image_ref = None
+        sent_message = await event.client.send_file(
             event.chat_id,
             START_IMAGE,
             caption=get_caption("home", user),
             parse_mode='html',
             buttons=get_keyboard("home")
         )
+        start_image_ref = media_reference(sent_message)
     except Exception as e:
         logger.error(f"Start command error: {e}")
         await event.reply(
@@ -265,95 +390,194 @@ async def menu_callback(event):
         logger.error(f"Menu callback error: {e}")
         await event.answer("Failed to update menu. Please try again.", alert=True)
 
-async def download_file_with_progress(url, file_path, event, msg, filename, filesize, cancel_event):
+async def download_file_with_progress(url, file_path, event, msg, filename, filesize, cancel_event, upload_client=None, job_id=None):
+    """Download url to file_path; with upload_client, stream it to Telegram and keep only the head on disk
+
+    Returns (mime_type, uploaded_file): mime_type is sniffed from the first chunk, uploaded_file
+    is the InputFile of a streamed upload.
+    """
     downloaded = 0
     last_update = 0
     last_progress = 0
-    chunk_size = 50 * 1024 * 1024  # 5MB chunks
+    mime_type = None
+    head = bytearray()
+    stream = None
+    sink = None
+    head_left = STREAM_HEAD_SIZE
+    next_report = 0
+    report_step = max(filesize // 100, DOWNLOAD_BUFFER_SIZE)
+    start_time = time.time()
+
+    async def report_progress(downloaded):
+        nonlocal last_update, last_progress
+        elapsed = time.time() - start_time
+        speed = downloaded / elapsed if elapsed > 0 else 0
+        progress = downloaded / filesize * 100 if filesize else 0
+        current_progress = int(progress)
+
+        if current_progress > last_progress or time.time() - last_update > 5:
+            # Create progress bar
+            bar = progress_bar(progress)
+            progress_text = (
+                f"⬇️ ᴅᴏᴡɴʟᴏᴀᴅɪɴɢ\n\n"
+                f"ғɪʟᴇ ɴᴀᴍᴇ: **{filename}**\n"
+                f"sɪᴢᴇ: {human_size(filesize)}\n\n"
+                f"ᴘʀᴏᴄᴇss:\n"
+                f"{bar} {progress:.1f}%\n"
+                f"sᴘᴇᴇᴅ: {human_size(speed)}/s"
+            )
+            progress_dispatcher.post(
+                event.client,
+                event.chat_id,
+                msg.id,
+                progress_text,
+                buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{event.sender_id}_{job_id}")]]
+            )
+            last_update = time.time()
+            last_progress = current_progress
     
     try:
         timeout_value = max(1800, filesize // (1024 * 1024))
         logger.info(f"Downloading {filename} with timeout: {timeout_value}s")
         
         async with aiohttp.ClientSession(timeout=ClientTimeout(total=timeout_value)) as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    raise Exception(f"HTTP Error {response.status}")
-                
-                content_length = int(response.headers.get('Content-Length', 0))
-                if content_length and content_length != filesize:
-                    logger.warning(f"Content-Length mismatch: API={human_size(filesize)} Actual={human_size(content_length)}")
-                    filesize = content_length
-                
-                content_type = response.headers.get('Content-Type', '').lower()
+            range_size = None
+            if upload_client is None and DOWNLOAD_SEGMENTS > 1 and filesize >= SEGMENT_MIN_SIZE:
+                range_size, content_type = await probe_ranges(session, url)
                 if 'text/html' in content_type:
-                    chunk = await response.content.read(4096)
-                    if b"<html" in chunk.lower() or b"<!doctype" in chunk.lower():
-                        raise Exception("Received HTML content instead of file")
-                    async with aiofiles.open(file_path, 'wb') as f:
-                        await f.write(chunk)
+                    range_size = None
+
+            if range_size:
+                if range_size != filesize:
+                    logger.warning(f"Content-Range mismatch: API={human_size(filesize)} Actual={human_size(range_size)}")
+                    filesize = range_size
+                logger.info(f"Downloading {filename} in {DOWNLOAD_SEGMENTS} segments")
+                await download_segmented(
+                    session,
+                    url,
+                    file_path,
+                    filesize,
+                    cancel_event,
+                    report_progress,
+                    segments=DOWNLOAD_SEGMENTS,
+                    retries=SEGMENT_RETRIES,
+                    buffer_size=DOWNLOAD_BUFFER_SIZE,
+                    buffers=DOWNLOAD_BUFFERS
+                )
+                # Segments land out of order, so sniff the head once it is on disk
+                async with aiofiles.open(file_path, 'rb') as f:
+                    mime_type = sniff_file_type(await f.read(SNIFF_SIZE), content_type, filename)
+            else:
+                async with session.get(url) as response:
+                    if response.status != 200:
+                        raise Exception(f"HTTP Error {response.status}")
+                    
+                    content_length = int(response.headers.get('Content-Length', 0))
+                    if content_length and content_length != filesize:
+                        logger.warning(f"Content-Length mismatch: API={human_size(filesize)} Actual={human_size(content_length)}")
+                        filesize = content_length
+                    
+                    if upload_client is not None and filesize > 0:
+                        stream = StreamingUpload(upload_client, filesize, filename, max_inflight=STREAM_MAX_INFLIGHT)
+
+                    async def write(cursor, chunk):
+                        nonlocal downloaded, head_left, mime_type
+                        if mime_type is None:
+                            head.extend(chunk[:SNIFF_SIZE - len(head)])
+                            if len(head) >= SNIFF_SIZE:
+                                mime_type = sniff_file_type(bytes(head), content_type, filename)
+                        if stream:
+                            await stream.feed(chunk)
+                            if head_left > 0:
+                                await cursor.write(chunk[:head_left])
+                                head_left -= len(chunk)
+                        else:
+                            await cursor.write(chunk)
                         downloaded += len(chunk)
-                
-                async with aiofiles.open(file_path, 'ab') as f:
-                    start_time = time.time()
-                    async for chunk in response.content.iter_chunked(chunk_size):
-                        if not chunk:
-                            continue
-                            
+                    
+                    content_type = response.headers.get('Content-Type', '').lower()
+                    first_chunk = b""
+                    if 'text/html' in content_type:
+                        first_chunk = await response.content.read(4096)
+                        if b"<html" in first_chunk.lower() or b"<!doctype" in first_chunk.lower():
+                            raise Exception("Received HTML content instead of file")
+                    
+                    # Reserve the blocks up front, then trim to what actually arrived
+                    on_disk = min(filesize, STREAM_HEAD_SIZE) if stream else filesize
+                    await asyncio.to_thread(lambda: os.close(preallocate(file_path, on_disk)))
+                    sink = DownloadSink(file_path, buffer_size=DOWNLOAD_BUFFER_SIZE, buffers=DOWNLOAD_BUFFERS).open()
+                    cursor = sink.cursor()
+                    if first_chunk:
+                        await write(cursor, first_chunk)
+                    async for chunk in response.content.iter_any():
                         # Check for cancellation
                         if cancel_event.is_set():
                             raise Exception("Download canceled by user")
                             
-                        await f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        elapsed = time.time() - start_time
-                        speed = downloaded / elapsed if elapsed > 0 else 0
-                        progress = downloaded / filesize * 100
-                        current_progress = int(progress)
-                        
-                        if current_progress > last_progress or time.time() - last_update > 5:
-                            try:
-                                # Create progress bar
-                                bar = progress_bar(progress)
-                                progress_text = (
-                                    f"⬇️ ᴅᴏᴡɴʟᴏᴀᴅɪɴɢ\n\n"
-                                    f"ғɪʟᴇ ɴᴀᴍᴇ: **{filename}**\n"
-                                    f"sɪᴢᴇ: {human_size(filesize)}\n\n"
-                                    f"ᴘʀᴏᴄᴇss:\n"
-                                    f"{bar} {progress:.1f}%\n"
-                                    f"sᴘᴇᴇᴅ: {human_size(speed)}/s"
-                                )
-                                await event.client.edit_message(
-                                    event.chat_id,
-                                    msg.id,
-                                    progress_text,
-                                    buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{event.sender_id}")]]
-                                )
-                                last_update = time.time()
-                                last_progress = current_progress
-                            except Exception as e:
-                                if "Message is not modified" not in str(e):
-                                    logger.warning(f"Progress update error: {e}")
+                        await write(cursor, chunk)
+                        if downloaded >= next_report:
+                            next_report = downloaded + report_step
+                            await report_progress(downloaded)
+                    cursor.flush()
+                    await sink.close(min(downloaded, STREAM_HEAD_SIZE) if stream else downloaded)
+                    sink = None
         
+        if stream:
+            if downloaded != filesize:
+                raise Exception(f"Size mismatch: Expected {human_size(filesize)}, got {human_size(downloaded)}")
+            return mime_type or sniff_file_type(bytes(head), content_type, filename), await stream.finish()
+
         if os.path.exists(file_path):
             actual_size = os.path.getsize(file_path)
             if actual_size != filesize:
                 raise Exception(f"Size mismatch: Expected {human_size(filesize)}, got {human_size(actual_size)}")
         
-        return content_type
+        return mime_type or sniff_file_type(bytes(head), content_type, filename), None
     except asyncio.TimeoutError:
+        if stream:
+            stream.abort()
         raise Exception(f"Download timed out after {timeout_value} seconds")
     except Exception as e:
+        if stream:
+            stream.abort()
         if os.path.exists(file_path):
             try:
                 os.remove(file_path)
             except:
                 pass
         raise e
+    finally:
+        if sink:
+            # Stop the writer thread of a failed or cancelled download
+            try:
+                await sink.close()
+            except Exception:
+                pass
+        # The caller edits msg next; a late progress state must not overwrite it
+        await progress_dispatcher.discard(event.chat_id, msg.id)
 
-async def upload_file(client, chat_id, file_path, thumb_path, caption, is_video, width=None, height=None, progress_callback=None):
+async def upload_file(client, chat_id, file_path, thumb_path, caption, is_video, media_info=None, probed=False, progress_callback=None):
     try:
+        # send_file cannot read the metadata of an InputFile, so get it while there is a path;
+        # probed means ffprobe already ran, so a None media_info is its answer
+        if is_video and not probed and isinstance(file_path, str):
+            media_info = await media_prober.probe(file_path)
+        if is_video and not (media_info and media_info["duration"]):
+            # Without a real duration Telethon makes up a 0 s, 1x1 video; send it as a file instead.
+            # Streamed uploads hit this for MP4s whose moov atom lies past the head kept on disk
+            logger.info("No media info for a video, sending it as a document")
+            is_video = False
+
+        # Push the parts over several connections first, send_file then only attaches the InputFile
+        if isinstance(file_path, str) and UPLOAD_PARALLELISM > 1:
+            file_path = await upload_parallel(
+                upload_pool or client,
+                file_path,
+                part_size=UPLOAD_PART_SIZE,
+                parallelism=UPLOAD_PARALLELISM,
+                progress_callback=progress_callback
+            )
+
         if is_video:
             return await client.send_file(
                 chat_id,
@@ -361,7 +585,7 @@ async def upload_file(client, chat_id, file_path, thumb_path, caption, is_video,
                 caption=caption,
                 supports_streaming=True,
                 thumb=thumb_path if thumb_path and os.path.exists(thumb_path) else None,
-                attributes=[],
+                attributes=[video_attributes(media_info)] if media_info else [],
                 video_note=False,
                 progress_callback=progress_callback,
                 timeout=UPLOAD_TIMEOUT
@@ -382,79 +606,74 @@ async def upload_file(client, chat_id, file_path, thumb_path, caption, is_video,
         raise
 
 async def broadcast_command(event):
+    """/broadcast as a reply sends that message to every user; /broadcast cancel and /broadcast resume control the run"""
     user = await event.get_sender()
     if user.id != OWNER_ID:
         await event.reply("❌ This command is restricted to the bot owner only.")
         return
     
-    if not event.is_reply:
+    action = event.raw_text.split()[1:2]
+    if action == ["cancel"]:
+        if broadcaster.cancel():
+            await event.reply("🛑 ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴀɴᴄᴇʟʟᴀᴛɪᴏɴ ʀᴇǫᴜᴇsᴛᴇᴅ. ᴜsᴇ /broadcast resume ᴛᴏ ᴄᴏɴᴛɪɴᴜᴇ ɪᴛ.")
+        else:
+            await event.reply("❌ No broadcast is running.")
+        return
+
+    if broadcaster.running:
+        await event.reply("❌ A broadcast is already running. Use /broadcast cancel to stop it.")
+        return
+
+    if action == ["resume"]:
+        broadcast = await broadcaster.find_resumable()
+        if not broadcast:
+            await event.reply("❌ There is no broadcast to resume.")
+            return
+    elif not event.is_reply:
         await event.reply("❌ Please reply to a message with /broadcast to broadcast it.")
         return
-    
-    broadcast_msg = await event.get_reply_message()
-    users = users_collection.find()
-    total_users = 0
-    success_count = 0
-    failed_count = 0
-    blocked_count = 0
+    else:
+        broadcast_msg = await event.get_reply_message()
+        broadcast = await broadcaster.create(broadcast_msg.chat_id, broadcast_msg.id)
     
     status_msg = await event.reply("📤 sᴛᴀʀᴛɪɴɢ ʙʀᴏᴀᴅᴄᴀsᴛ...")
-    
-    async for user_doc in users:
-        total_users += 1
-        user_id = user_doc["_id"]
-        
-        if await blocked_users_collection.find_one({"user_id": user_id}):
-            blocked_count += 1
-            continue
-        
-        try:
-            await event.client.forward_messages(user_id, broadcast_msg)
-            success_count += 1
-        except Exception as e:
-            if "bot was blocked" in str(e).lower():
-                blocked_count += 1
-                await blocked_users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$set": {"blocked_at": datetime.datetime.now()}},
-                    upsert=True
-                )
-            else:
-                failed_count += 1
-                logger.error(f"Failed to send to {user_id}: {str(e)}")
-        
-        if total_users % 10 == 0:
-            await event.client.edit_message(
-                status_msg.chat_id,
-                status_msg.id,
-                f"📤 ʙʀᴏᴀᴅᴄᴀsᴛɪɴɢ...\nᴛᴏᴛᴀʟ: {total_users}\nsᴜᴄᴄᴇss: {success_count}\nғᴀɪʟᴇᴅ: {failed_count}\nʙʟᴏᴄᴋᴇᴅ: {blocked_count}"
-            )
-    
-    await event.client.edit_message(
-        status_msg.chat_id,
-        status_msg.id,
-        f"✅ ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴘʟᴇᴛᴇᴅ!\nᴛᴏᴛᴀʟ: {total_users}\nsᴜᴄᴄᴇss: {success_count}\nғᴀɪʟᴇᴅ: {failed_count}\nʙʟᴏᴄᴋᴇᴅ: {blocked_count}"
-    )
+
+    def counts_text(counts):
+        return f"ᴛᴏᴛᴀʟ: {counts['total']}\nsᴜᴄᴄᴇss: {counts['success']}\nғᴀɪʟᴇᴅ: {counts['failed']}\nʙʟᴏᴄᴋᴇᴅ: {counts['blocked']}"
+
+    async def show_progress(counts):
+        progress_dispatcher.post(event.client, status_msg.chat_id, status_msg.id, f"📤 ʙʀᴏᴀᴅᴄᴀsᴛɪɴɢ...\n{counts_text(counts)}")
+
+    try:
+        state = await broadcaster.run(event.client, broadcast, on_progress=show_progress)
+    except Exception as e:
+        logger.error(f"Broadcast failed: {e}")
+        await progress_dispatcher.discard(status_msg.chat_id, status_msg.id)
+        await status_msg.edit(f"❌ ʙʀᴏᴀᴅᴄᴀsᴛ ғᴀɪʟᴇᴅ: {str(e)[:200]}\nᴜsᴇ /broadcast resume ᴛᴏ ᴄᴏɴᴛɪɴᴜᴇ ɪᴛ.")
+        return
+
+    counts = broadcast["counts"]
+    await progress_dispatcher.discard(status_msg.chat_id, status_msg.id)
+    if state == "canceled":
+        await status_msg.edit(f"🛑 ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴀɴᴄᴇʟᴇᴅ!\n{counts_text(counts)}")
+        return
+    await status_msg.edit(f"✅ ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴘʟᴇᴛᴇᴅ!\n{counts_text(counts)}")
     
     if LOG_CHANNEL_ID:
         try:
             await event.client.send_message(
                 LOG_CHANNEL_ID,
-                f"📢 ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴘʟᴇᴛᴇᴅ:\nᴛᴏᴛᴀʟ: {total_users}, sᴜᴄᴄᴇss: {success_count}, ғᴀɪʟᴇᴅ: {failed_count}, ʙʟᴏᴄᴋᴇᴅ: {blocked_count}"
+                f"📢 ʙʀᴏᴀᴅᴄᴀsᴛ ᴄᴏᴍᴘʟᴇᴛᴇᴅ:\nᴛᴏᴛᴀʟ: {counts['total']}, sᴜᴄᴄᴇss: {counts['success']}, ғᴀɪʟᴇᴅ: {counts['failed']}, ʙʟᴏᴄᴋᴇᴅ: {counts['blocked']}"
             )
         except Exception as e:
             logger.error(f"Failed to log broadcast: {e}")
 
 async def status_command(event):
-    stats = await stats_collection.find_one({})
-    if not stats:
-        await event.reply("📊 ʙᴏᴛ sᴛᴀᴛɪsᴛɪᴄs ɴᴏᴛ ᴀᴠᴀɪʟᴀʙʟᴇ ʏᴇᴛ.")
-        return
-    
-    total_users = stats.get("total_users", 0)
-    total_downloads = stats.get("total_downloads", 0)
-    successful_downloads = stats.get("successful_downloads", 0)
-    failed_downloads = stats.get("failed_downloads", 0)
+    totals = stats.totals
+    total_users = totals["total_users"]
+    total_downloads = totals["total_downloads"]
+    successful_downloads = totals["successful_downloads"]
+    failed_downloads = totals["failed_downloads"]
     
     success_rate = (successful_downloads / total_downloads * 100) if total_downloads > 0 else 0
     
@@ -477,30 +696,37 @@ async def astatus_command(event):
         await event.reply("❌ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ ɪs ʀᴇsᴛʀɪᴄᴛᴇᴅ ᴛᴏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴏɴʟʏ.")
         return
     
-    stats = await stats_collection.find_one({})
-    if not stats:
-        await event.reply("📊 ʙᴏᴛ sᴛᴀᴛɪsᴛɪᴄs ɴᴏᴛ ᴀᴠᴀɪʟᴀʙʟᴇ ʏᴇᴛ.")
-        return
-    
-    total_users = stats.get("total_users", 0)
-    total_downloads = stats.get("total_downloads", 0)
-    successful_downloads = stats.get("successful_downloads", 0)
-    failed_downloads = stats.get("failed_downloads", 0)
+    totals = stats.totals
+    total_users = totals["total_users"]
+    total_downloads = totals["total_downloads"]
+    successful_downloads = totals["successful_downloads"]
+    failed_downloads = totals["failed_downloads"]
     
     success_rate = (successful_downloads / total_downloads * 100) if total_downloads > 0 else 0
+
+    day_downloads = await stats.last_hours("total_downloads")
     
-    most_active_users = await users_collection.find().sort("download_count", -1).limit(5).to_list(length=2)
+    most_active_users = await users_collection.find(
+        {}, {"name": 1, "download_count": 1}
+    ).sort("download_count", -1).limit(5).to_list(length=5)
     active_users_text = "\n".join(
         [f"{i+1}. {user['name']} ({user['_id']}) - {user.get('download_count', 0)} downloads" 
          for i, user in enumerate(most_active_users)]
     )
     
-    blocked_users = await blocked_users_collection.find().sort("blocked_at", -1).limit(10).to_list(length=10)
+    blocked_users = await blocked_users_collection.find(
+        {}, {"user_id": 1, "blocked_at": 1, "_id": 0}
+    ).sort("blocked_at", -1).limit(10).to_list(length=10)
     blocked_users_text = "\n".join(
         [f"• ᴜsᴇʀ ɪᴅ: {user['user_id']} - ʙʟᴏᴄᴋᴇᴅ ᴀᴛ: {user['blocked_at'].strftime('%Y-%m-%d %H:%M')}"
          for user in blocked_users]
     ) if blocked_users else "No blocked users"
     
+    slow_queries_text = f"{slow_queries.count}"
+    if slow_queries.recent:
+        slowest = max(slow_queries.recent, key=lambda query: query[3])
+        slow_queries_text += f", slowest recent: {slowest[1]} {slowest[3]:.0f} ms"
+    
     response = (
         f"🔒 ᴀᴅᴍɪɴ ꜱᴛᴀᴛᴜꜱ:\n\n"
         f"📊 ɢᴇɴᴇʀᴀʟ ꜱᴛᴀᴛꜱ:\n"
@@ -509,13 +735,61 @@ async def astatus_command(event):
         f"✅ ᴜᴘʟᴏᴀᴅᴇᴅ: {successful_downloads}\n"
         f"❌ ꜰᴀɪʟᴇᴅ: {failed_downloads}\n"
         f"📈 ꜱᴜᴄᴄᴇꜱꜱ ʀᴀᴛᴇ: {success_rate:.2f}%\n"
-        f"🆙 ᴜᴘᴛɪᴍᴇ: {get_uptime()}\n\n"
+        f"🕐 ʟᴀsᴛ 24ʜ ᴅᴏᴡɴʟᴏᴀᴅꜱ: {day_downloads}\n"
+        f"🆙 ᴜᴘᴛɪᴍᴇ: {get_uptime()}\n"
+        f"✏️ ᴘʀᴏɢʀᴇss ᴇᴅɪᴛs: {progress_dispatcher.sent} sent, {progress_dispatcher.dropped} dropped, {progress_dispatcher.flood_waits} flood waits\n"
+        f"🐢 sʟᴏᴡ ǫᴜᴇʀɪᴇs (>{SLOW_QUERY_MS} ms): {slow_queries_text}\n\n"
         f"⭐ ᴛᴏᴘ ᴀᴄᴛɪᴠᴇ ᴜꜱᴇʀꜱ:\n{active_users_text}\n\n"
         f"🚫 ʙʟᴏᴄᴋᴇᴅ ᴜꜱᴇʀꜱ:\n{blocked_users_text}"
     )
     
     await event.reply(response)
 
+async def perf_command(event):
+    """/perf [hours]: phase percentiles and the slowest jobs from the job traces, last 24 hours by default"""
+    user = await event.get_sender()
+    if user.id != OWNER_ID:
+        await event.reply("❌ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ ɪs ʀᴇsᴛʀɪᴄᴛᴇᴅ ᴛᴏ ᴛʜᴇ ʙᴏᴛ ᴏᴡɴᴇʀ ᴏɴʟʏ.")
+        return
+
+    args = event.raw_text.split()[1:2]
+    hours = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 24
+    try:
+        phases, jobs = await tracer.summary(hours)
+    except Exception as e:
+        logger.error(f"Perf summary error: {e}")
+        await event.reply("❌ Failed to read job traces.")
+        return
+    if not phases:
+        await event.reply(f"❌ No job traces in the last {hours}h.")
+        return
+
+    phase_lines = "\n".join(
+        f"• {phase}: {count}× p50 {p50:.1f}s, p95 {p95:.1f}s, p99 {p99:.1f}s"
+        for phase, (count, p50, p95, p99) in sorted(phases.items())
+    )
+    job_lines = []
+    for i, job in enumerate(jobs, 1):
+        slowest = max(job["spans"], key=lambda span: span["duration"], default=None)
+        line = (
+            f"{i}. {job['duration']:.1f}s {job['state']}, {job.get('files', 0)} files, "
+            f"{human_size(job['bytes'])}, via {job.get('backend', '-')}"
+        )
+        if slowest:
+            line += f"\n   slowest: {slowest['phase']} {slowest['duration']:.1f}s"
+            if slowest.get("host"):
+                line += f" from {slowest['host']}"
+        job_lines.append(line)
+
+    response = (
+        f"⏱️ ᴘᴇʀғᴏʀᴍᴀɴᴄᴇ, ʟᴀsᴛ {hours}ʜ:\n\n"
+        f"{phase_lines}\n\n"
+        f"🐢 sʟᴏᴡᴇsᴛ ᴊᴏʙs:\n" + "\n".join(job_lines)
+    )
+    if tracer.dropped:
+        response += f"\n\n⚠️ {tracer.dropped} traces dropped"
+    await event.reply(response)
+
 # Track bot startup time for uptime calculation
 START_TIME = time.time()
 
@@ -526,221 +800,217 @@ def get_uptime():
     minutes, seconds = divmod(uptime_seconds, 60)
     return f"{days}d {hours}h {minutes}m {seconds}s"
 
-async def fetch_alt_api(link):
+async def download_task(event, user, msg, text, job_id, cancel_event, delivered=()):
+    """Resolve a link and deliver its files; delivered holds file indexes a resumed job already sent"""
+    user_id = user.id
+    cancel_button = Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")
+    items = []
+    final_state = None  # Left unset when the task is torn down, so the job stays resumable
+    trace = tracer.start(job_id, user_id, text)
+
+    def show_status(text, buttons=None):
+        """Queue a status for msg behind the progress edits and their rate limits"""
+        progress_dispatcher.post(event.client, event.chat_id, msg.id, text, buttons=buttons)
+
+    async def final_status(text):
+        """Edit msg at once, after dropping any status still queued for it"""
+        await progress_dispatcher.discard(event.chat_id, msg.id)
+        await msg.edit(text, buttons=None)
+
     try:
-        timeout = aiohttp.ClientTimeout(total=120)
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
-            "Upgrade-Insecure-Requests": "1",
-            "Sec-Fetch-Dest": "document",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "none",
-            "Sec-Fetch-User": "?1",
-            "Pragma": "no-cache",
-            "Cache-Control": "no-cache"
-        }
+        last_error = None
+
+        share_key = share_id(text)
+        folder_data = await link_cache.get(share_key) if share_key else None
+        from_cache = folder_data is not None
+
+        if from_cache:
+            trace.attrs["backend"] = "link_cache"
+            logger.info(f"Resolved {share_key} from cache")
+            show_status("🔗 sᴛᴀʀᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
+        else:
+            async def on_retry(attempt, attempts, key_number):
+                show_status(f"🔗 ʀᴇᴛʀʏɪɴɢ ({attempt}/{attempts}) ᴡɪᴛʜ ᴀᴘɪ ᴋᴇʏ #{key_number}...", buttons=[[cancel_button]])
+
+            def on_attempt(backend, elapsed, ok):
+                trace.add("resolve.attempt", elapsed, backend=backend, ok=ok)
+                if ok:
+                    trace.attrs.setdefault("backend", backend)
+
+            with trace.span("resolve") as span:
+                folder_data = await resolver.resolve(text, cancel_event=cancel_event, on_retry=on_retry, on_attempt=on_attempt)
+            observe_phase("resolve", span["duration"])
+            if cancel_event.is_set():
+                final_state = "canceled"
+                await final_status("❌ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴀɴᴄᴇʟᴇᴅ.")
+                return
+
+            if folder_data and len(folder_data) > 1:
+                total_files = len(folder_data)
+                status = ""
+                if total_files > MAX_FOLDER_FILES:
+                    folder_data = folder_data[:MAX_FOLDER_FILES]
+                    total_files = MAX_FOLDER_FILES
+                    # One status replaces the next, so the warning goes in the same one
+                    status = f"⚠️ ғᴏʟᴅᴇʀ ʜᴀs ᴍᴏʀᴇ ᴛʜᴀɴ {MAX_FOLDER_FILES} ғɪʟᴇs. ᴅᴏᴡɴʟᴏᴀᴅɪɴɢ ғɪʀsᴛ {MAX_FOLDER_FILES} ғɪʟᴇs.\n\n"
+                show_status(f"{status}📁 ғᴏᴜɴᴅ {total_files} ғɪʟᴇs. sᴛᴀʀᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
+            elif folder_data:
+                show_status("🔗 sᴛᴀʀᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
+
+            if folder_data and share_key:
+                await link_cache.set(share_key, folder_data)
+
+        if not folder_data:
+            final_state = "failed"
+            error_msg = f"❌ ғᴀɪʟᴇᴅ ᴛᴏ ɢᴇᴛ ᴅᴏᴡɴʟᴏᴀᴅ ʟɪɴᴋs"
+            stats.incr("total_downloads")
+            stats.incr("failed_downloads")
+            await final_status(error_msg)
+            return
+
+        await job_store.set_state(job_id, "running")
+        trace.attrs["files"] = len(folder_data)
+        successful_files = 0
+        failed_files = 0
+        skipped_files = 0
+        job_canceled = False
+        active_file_downloads = 0
         
-        async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
-            async with session.get(f"https://lavdya.ninja1.workers.dev/?url={link}") as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if isinstance(data, dict) and (data.get('direct_link') or data.get('link')):
-                        return data
-                return None
-    except Exception as e:
-        logger.warning(f"Alternative API error: {str(e)}")
-        return None
+        if LINK_CHANNEL_ID and not delivered:
+            try:
+                await event.client.send_message(
+                    LINK_CHANNEL_ID,
+                    f"🌐 ɴᴇᴡ ʟɪɴᴋ: {text} \nby {user.first_name}",
+                    parse_mode="md"
+                )
+            except Exception as e:
+                logger.error(f"Link channel error: {e}")
 
-async def handle_message(event):
-    text = event.raw_text.strip()
-    if not TERABOX_LINK_REGEX.search(text):
-        return
+        def record_failure():
+            nonlocal failed_files
+            stats.incr("total_downloads")
+            stats.incr("failed_downloads")
+            failed_files += 1
 
-    if not await check_membership(event):
-        buttons = [[Button.url("ᴊᴏɪɴ ᴄʜᴀɴɴᴇʟ", f"https://t.me/{CHANNEL_USER}")]]
-        try:
-            await event.reply(
-                "🔒 ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ ᴛᴏ ᴜsᴇ ᴛʜɪs ʙᴏᴛ.",
-                buttons=buttons)
-        except Exception as e:
-            logger.error(f"Membership check reply error: {e}")
-        return
+        def record_success():
+            nonlocal successful_files
+            stats.incr("total_downloads")
+            stats.incr("successful_downloads")
+            stats.user_download(user.id)
+            successful_files += 1
 
-    user = await event.get_sender()
-    try:
-        # Create cancel button
-        cancel_button = Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}")
-        msg = await event.reply("🔗 ɢᴇᴛᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ ʟɪɴᴋ...", buttons=[[cancel_button]])
-    except Exception as e:
-        logger.error(f"Error sending initial message: {e}")
-        return
+        def cleanup(item):
+            for path in [item.get("file_path"), item.get("thumb_path")]:
+                if path and os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except Exception as e:
+                        logger.error(f"Error deleting file {path}: {e}")
+            if item["reserved"] is not None:
+                scratch.release(item["reserved"])
+                item["reserved"] = None
 
-    # Create cancel event for this specific download
-    cancel_event = asyncio.Event()
-    user_id = user.id
-    
-    # Add to active downloads
-    active_downloads[user_id] = cancel_event
+        async def resolve_stage(item):
+            """Work out names and paths, and whether the file was already delivered once"""
+            file_data = item["file_data"]
+            item["filename"] = clean_filename(file_data.get("file_name", "file"))
+            item["filesize"] = int(file_data.get("sizebytes", 0))
+            item["file_path"] = scratch.path(job_id, item["index"], item["filename"])
+            item["thumb_path"] = f"{item['file_path']}.jpg"
+            item["caption"] = f"🎬ғɪʟᴇ ɴᴀᴍᴇ: {item['filename']}\n\n📦 sɪᴢᴇ: {human_size(item['filesize'])}"
+            if item["cache_key"]:
+                item["cached"] = await content_cache.get(item["cache_key"])
+            # Fetch the API thumbnail while the file downloads
+            thumb_url = file_data.get("thumbnail")
+            if thumb_url and not item["cached"]:
+                item["thumb_task"] = thumbnail_cache.prefetch(
+                    resolver.session, item["cache_key"] or thumb_url, thumb_url, item["thumb_path"]
+                )
 
-    async def download_task():
-        nonlocal msg
-        try:
-            last_error = None
-            folder_data = None
-            use_alt_api = False
-
-            # First, try alternative API
-            alt_api_data = await fetch_alt_api(text)
-            if alt_api_data:
-                folder_data = [{
-                    "file_name": alt_api_data['file_name'],
-                    "direct_link": alt_api_data.get('direct_link', ''),
-                    "link": alt_api_data.get('link', ''),
-                    "thumbnail": alt_api_data.get('thumb', ''),
-                    "size": alt_api_data.get('size', ''),
-                    "sizebytes": alt_api_data.get('sizebytes', 0)
-                }]
-                use_alt_api = True
-                total_files = 1
-                await msg.edit("🔗 sᴛᴀʀᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
-            else:
-                # Then try RapidAPI
-                for api_key in API_KEYS:
-                    for retry in range(10):  # Added retry loop
-                        try:
-                            # Check if canceled
-                            if cancel_event.is_set():
-                                await msg.edit("❌ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴀɴᴄᴇʟᴇᴅ.", buttons=None)
-                                return
-                            if retry > 0:
-                                await msg.edit(f"🔗 ʀᴇᴛʀʏɪɴɢ ({retry+1}/10) ᴡɪᴛʜ ᴀᴘɪ ᴋᴇʏ...", buttons=[[cancel_button]])
-
-                            res = requests.get(
-                                f"https://{RAPIDAPI_HOST}/url",
-                                params={"url": text},
-                                headers={
-                                    "X-RapidAPI-Key": api_key,
-                                    "X-RapidAPI-Host": RAPIDAPI_HOST
-                                },
-                                timeout=60
-                            )
-                            res.raise_for_status()
-                            resp_json = res.json()
-                            
-                            if not resp_json or not isinstance(resp_json, list) or len(resp_json) == 0:
-                                raise Exception("Invalid API response")
-                            
-                            folder_data = resp_json
-                            total_files = len(folder_data)
-                            if total_files > MAX_FOLDER_FILES:
-                                folder_data = folder_data[:MAX_FOLDER_FILES]
-                                total_files = MAX_FOLDER_FILES
-                                await msg.edit(f"⚠️ ғᴏʟᴅᴇʀ ʜᴀs ᴍᴏʀᴇ ᴛʜᴀɴ {MAX_FOLDER_FILES} ғɪʟᴇs. ᴅᴏᴡɴʟᴏᴀᴅɪɴɢ ғɪʀsᴛ {MAX_FOLDER_FILES} ғɪʟᴇs.", buttons=[[cancel_button]])
-                            
-                            await msg.edit(f"📁 ғᴏᴜɴᴅ {total_files} ғɪʟᴇs. sᴛᴀʀᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
-                            break
-                        except Exception as e:
-                            last_error = e
-                            logger.error(f"API key {api_key} failed (attempt {retry+1}): {str(e)}")
-                            if retry < 2:  # Only sleep if we'll retry again
-                                await asyncio.sleep(5)  # Short delay before retry
-                            else:
-                                continue  
-
-            if not folder_data:
-                error_msg = f"❌ ғᴀɪʟᴇᴅ ᴛᴏ ɢᴇᴛ ᴅᴏᴡɴʟᴏᴀᴅ ʟɪɴᴋs"
-                await stats_collection.update_one({}, {
-                    "$inc": {
-                        "total_downloads": 1,
-                        "failed_downloads": 1
-                    }
-                })
-                await msg.edit(error_msg, buttons=None)
+        async def download_stage(item):
+            nonlocal from_cache, job_canceled, skipped_files, last_error, active_file_downloads
+            if item["status"] or item["cached"]:
                 return
 
-            successful_files = 0
-            failed_files = 0
-            skipped_files = 0
-            file_path = None
-            thumb_path = None
-            
-            if LINK_CHANNEL_ID:
-                try:
-                    await event.client.send_message(
-                        LINK_CHANNEL_ID,
-                        f"🌐 ɴᴇᴡ ʟɪɴᴋ: {text} \nby {user.first_name}",
-                        parse_mode="md"
-                    )
-                except Exception as e:
-                    logger.error(f"Link channel error: {e}")
-            
-            async with download_semaphore:
-                for file_index, file_data in enumerate(folder_data, 1):
-                    # Reset cancellation for each new file
-                    if cancel_event.is_set():
-                        cancel_event.clear()
-                        
-                    # Check if entire process was canceled
-                    if user_id not in active_downloads:
-                        await msg.edit("❌ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴀɴᴄᴇʟᴇᴅ.", buttons=None)
-                        return
-                        
-                    filename = file_data.get("file_name", "file")
-                    dlink = file_data.get("direct_link") or file_data.get("link")
-                    alt_link = file_data.get("link")
-                    filesize = int(file_data.get("sizebytes", 0))
-                    thumb_url = file_data.get("thumbnail")
-
-                    filename = re.sub(r'[\\/*?:"<>|]', "_", filename)
-                    if '.' not in filename:
-                        if "video" in filename.lower():
-                            filename += ".mp4"
-                        elif "image" in filename.lower() or "photo" in filename.lower():
-                            filename += ".jpg"
-                        else:
-                            filename += ".bin"
+            # Check if entire process was canceled
+            if job_id not in active_downloads:
+                job_canceled = True
+                item["status"] = "skipped"
+                return
 
-                    file_path = f"{user.id}_{filename}"
-                    thumb_path = f"{file_path}.jpg"
+            # Reset cancellation for each new file, unless it is aimed at one still downloading
+            if cancel_event.is_set() and not active_file_downloads:
+                cancel_event.clear()
 
-                    await msg.edit(f"📁 ᴘʀᴏᴄᴇssɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}: {filename}", buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}")]])
+            file_index = item["index"]
+            filename = item["filename"]
+            file_path = item["file_path"]
+            file_data = item["file_data"]
+            dlink = file_data.get("direct_link") or file_data.get("link")
+            alt_link = file_data.get("link")
 
-                    download_success = False
-                    download_urls = set()
-                    
-                    if dlink:
-                        download_urls.add(dlink)
-                    if alt_link and alt_link != dlink:
-                        download_urls.add(alt_link)
-                        
+            show_status(f"📁 ᴘʀᴏᴄᴇssɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}: {filename}", buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")]])
+
+            download_success = False
+            download_urls = set()
+            if dlink:
+                download_urls.add(dlink)
+            if alt_link and alt_link != dlink:
+                download_urls.add(alt_link)
+
+            async def show_queue_position(position, eta):
+                text = f"⏳ ɪɴ ǫᴜᴇᴜᴇ: #{position + 1}\n\n📁 ғɪʟᴇ {file_index}/{len(folder_data)}: {filename}"
+                if eta:
+                    text += f"\nᴇᴛᴀ: ~{human_time(eta)}"
+                show_status(text, buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")]])
+
+            async def show_disk_wait():
+                show_status(
+                    f"💾 ᴡᴀɪᴛɪɴɢ ғᴏʀ ᴅɪsᴋ sᴘᴀᴄᴇ...\n\n📁 ғɪʟᴇ {file_index}/{len(folder_data)}: {filename}",
+                    buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")]]
+                )
+
+            active_file_downloads += 1
+            slot = None
+            with trace.span("wait", file=file_index):
+                if item["reserved"] is None:
+                    # Streamed uploads only keep the head on disk
+                    size = min(item["filesize"], STREAM_HEAD_SIZE) if STREAM_UPLOAD else item["filesize"]
+                    item["reserved"] = await scratch.reserve(size, cancel_event=cancel_event, on_wait=show_disk_wait)
+                if item["reserved"] is not None:
+                    slot = await scheduler.acquire(user_id, job_id, cancel_event=cancel_event, on_wait=show_queue_position)
+                await progress_dispatcher.discard(event.chat_id, msg.id)
+            try:
+                if slot is None:
+                    item["status"] = "skipped"
+                else:
                     for download_url in download_urls:
                         try:
                             if cancel_event.is_set():
                                 # Skip this file but continue with next
-                                await msg.edit(f"⏭️ sᴋɪᴘᴘᴇᴅ ғɪʟᴇ {file_index}: {filename}", buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}")]])
-                                skipped_files += 1
+                                item["status"] = "skipped"
                                 break
-                                
-                            content_type = await download_file_with_progress(
-                                download_url, 
-                                file_path, 
-                                event, 
-                                msg, 
-                                filename, 
-                                filesize,
-                                cancel_event
-                            )
+
+                            with trace.span("download", file=file_index, host=urlparse(download_url).hostname) as span:
+                                item["mime_type"], item["uploaded_file"] = await download_file_with_progress(
+                                    download_url, 
+                                    file_path, 
+                                    event, 
+                                    msg, 
+                                    filename, 
+                                    item["filesize"],
+                                    cancel_event,
+                                    upload_client=(upload_pool or event.client) if STREAM_UPLOAD else None,
+                                    job_id=job_id
+                                )
+                                span["size"] = item["filesize"]
+                            observe_phase("download", span["duration"], item["filesize"])
                             download_success = True
                             break
                         except Exception as e:
                             if "Download canceled" in str(e):
                                 # Skip this file but continue with next
-                                await msg.edit(f"⏭️ sᴋɪᴘᴘᴇᴅ ғɪʟᴇ {file_index}: {filename}", buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}")]])
-                                skipped_files += 1
+                                item["status"] = "skipped"
                                 break
                             else:
                                 last_error = e
@@ -750,191 +1020,339 @@ async def handle_message(event):
                                         os.remove(file_path)
                                     except:
                                         pass
-                    
-                    if not download_success and not cancel_event.is_set():
-                        # Only count as failed if not canceled by user
-                        await stats_collection.update_one({}, {
-                            "$inc": {
-                                "total_downloads": 1,
-                                "failed_downloads": 1
-                            }
-                        })
-                        failed_files += 1
-                        continue
-                    
-                    # If canceled during download, skip to next file
-                    if cancel_event.is_set():
-                        cancel_event.clear()
-                        skipped_files += 1
-                        continue
-                    
-                    mime_type = detect_file_type(file_path)
-                    logger.info(f"Detected MIME type: {mime_type} for {file_path}")
+            finally:
+                active_file_downloads -= 1
+                if slot is not None:
+                    scheduler.release(user_id, slot)
 
-                    caption = f"🎬ғɪʟᴇ ɴᴀᴍᴇ: {filename}\n\n📦 sɪᴢᴇ: {human_size(filesize)}"
+            if item["status"] == "skipped" or (not download_success and cancel_event.is_set()):
+                item["status"] = "skipped"
+                skipped_files += 1
+                cleanup(item)
+                show_status(f"⏭️ sᴋɪᴘᴘᴇᴅ ғɪʟᴇ {file_index}: {filename}", buttons=[[Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")]])
+                return
 
-                    try:
-                        # Remove cancel button before upload
-                        await msg.edit(f"✅ ғɪʟᴇ {file_index}/{len(folder_data)} ᴅᴏᴡɴʟᴏᴀᴅᴇᴅ! sᴛᴀʀᴛɪɴɢ ᴜᴘʟᴏᴀᴅ...", buttons=None)
-                        await asyncio.sleep(2)
-                    except:
-                        pass
-                    
-                    is_video = mime_type.startswith("video/")
-                    width, height = (None, None)
-                    
-                    if is_video:
-                        await asyncio.to_thread(generate_thumbnail, file_path, thumb_path)
-                        width, height = await asyncio.to_thread(get_video_dimensions, file_path)
-                        logger.info(f"Video dimensions: {width}x{height}")
-
-                    # Create upload status message with progress bar
-                    upload_msg = await event.reply(f"📤 ᴜᴘʟᴏᴀᴅɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}:\n\nғɪʟᴇ ɴᴀᴍᴇ: {filename}\n\nᴘʀᴏᴄᴇss:\n{progress_bar(0)} 0%")
-                    last_progress_update = time.time()
-                    last_percent_sent = 0
-                    
-                    # Progress callback for upload
-                    def progress_callback(current, total):
-                        nonlocal last_progress_update, last_percent_sent
-                        percent = current / total * 100
-                        current_percent = int(percent)
-                        
-                        # Only update if progress changed by at least 1% or 5 seconds passed
-                        if current_percent > last_percent_sent or time.time() - last_progress_update > 5:
-                            try:
-                                bar = progress_bar(percent)
-                                asyncio.create_task(event.client.edit_message(
-                                    upload_msg.chat_id,
-                                    upload_msg.id,
-                                    f"📤 ᴜᴘʟᴏᴀᴅɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}:\n\nғɪʟᴇ ɴᴀᴍᴇ: {filename}\n\nᴘʀᴏᴄᴇss:\n{bar} {percent:.1f}%"
-                                ))
-                                last_progress_update = time.time()
-                                last_percent_sent = current_percent
-                            except Exception:
-                                pass  # Avoid flooding errors
-                    
-                    try:
-                        # Upload to user with progress callback
-                        sent_message = await upload_file(
-                            client=event.client,
-                            chat_id=event.chat_id,
-                            file_path=file_path,
-                            thumb_path=thumb_path,
-                            caption=caption,
-                            is_video=is_video,
-                            width=width,
-                            height=height,
-                            progress_callback=progress_callback
-                        )
-                        asyncio.create_task(
-                            delete_message_after_delay(
-                                event.client,
-                                event.chat_id,
-                                sent_message.id,
-                                1800  # 30 minutes
-                            )
-                        )
-                        
-                        # Update upload message to completion
-                        await event.client.edit_message(
-                            upload_msg.chat_id,
-                            upload_msg.id,
-                            f"✅ ғɪʟᴇ {file_index}/{len(folder_data)} ᴜᴘʟᴏᴀᴅᴇᴅ!"
-                        )
-                        await asyncio.sleep(2)
+            if not download_success:
+                # A cached direct link that no longer downloads has gone stale
+                if from_cache:
+                    await link_cache.invalidate(share_key)
+                    from_cache = False
+                # Only count as failed if not canceled by user
+                item["status"] = "failed"
+                record_failure()
+                cleanup(item)
+
+        async def probe_stage(item):
+            if item["status"] or item["cached"]:
+                return
+
+            file_path = item["file_path"]
+            mime_type = item["mime_type"]
+            logger.info(f"Detected MIME type: {mime_type} for {file_path}")
+            probe_start = time.monotonic()
+
+            item["is_video"] = mime_type.startswith("video/")
+            # Duration and dimensions always come from ffprobe, Telegram needs them for the video attribute
+            if item["is_video"]:
+                item["media_info"] = await media_prober.probe(file_path)
+                item["probed"] = True
+                if item["media_info"]:
+                    logger.info(f"Video info: {item['media_info']}")
+
+            if item["thumb_task"]:
+                item["thumb"] = await item["thumb_task"]
+            # The API thumbnail only saves the ffmpeg frame grab
+            if item["media_info"] and not item["thumb"]:
+                if await media_prober.thumbnail(file_path, item["thumb_path"], item["media_info"]["duration"]):
+                    item["thumb"] = item["thumb_path"]
+            probe_time = time.monotonic() - probe_start
+            observe_phase("probe", probe_time)
+            trace.add("probe", probe_time, file=item["index"], ffprobe=item["media_info"] is not None)
+
+        async def upload_stage(item):
+            if item["status"]:
+                return
+
+            file_index = item["index"]
+            filename = item["filename"]
+
+            if item["cached"]:
+                with trace.span("send_cached", file=file_index):
+                    sent_message = await content_cache.send(
+                        event.client, event.chat_id, item["cache_key"], item["caption"], doc=item["cached"]
+                    )
+                if sent_message:
+                    item["status"] = "cached"
+                    await job_store.checkpoint(job_id, file_index)
+                    await deletion_scheduler.schedule(event.chat_id, sent_message.id, DELETE_AFTER)
+                    record_success()
+                    return
+                # The cached reference is gone, fetch the file after all
+                item["cached"] = None
+                await download_stage(item)
+                await probe_stage(item)
+                if item["status"]:
+                    return
+
+            # Remove cancel button before upload
+            show_status(f"✅ ғɪʟᴇ {file_index}/{len(folder_data)} ᴅᴏᴡɴʟᴏᴀᴅᴇᴅ! sᴛᴀʀᴛɪɴɢ ᴜᴘʟᴏᴀᴅ...")
+            await asyncio.sleep(2)
+
+            # Create upload status message with progress bar
+            upload_text = f"📤 ᴜᴘʟᴏᴀᴅɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}:\n\nғɪʟᴇ ɴᴀᴍᴇ: {filename}\n\nᴘʀᴏᴄᴇss:\n{progress_bar(0)} 0%"
+            upload_msg = await event.reply(upload_text)
+            last_percent_sent = 0
+            upload_queued = False
+
+            async def show_upload_queue(position, eta):
+                nonlocal upload_queued
+                upload_queued = True
+                text = f"⏳ ᴜᴘʟᴏᴀᴅ ǫᴜᴇᴜᴇ: #{position + 1}\n\n📁 ғɪʟᴇ {file_index}/{len(folder_data)}: {filename}"
+                if eta:
+                    text += f"\nᴇᴛᴀ: ~{human_time(eta)}"
+                progress_dispatcher.post(event.client, upload_msg.chat_id, upload_msg.id, text)
+
+            # Uploads share the sender pool, so they queue fairly for a slot of their own.
+            # A downloaded file is never dropped, so the wait ignores cancel_event
+            with trace.span("upload_wait", file=file_index):
+                upload_slot = await upload_scheduler.acquire(user_id, job_id, on_wait=show_upload_queue)
+            if upload_queued:
+                progress_dispatcher.post(event.client, upload_msg.chat_id, upload_msg.id, upload_text)
+
+            # Progress callback for upload
+            def progress_callback(current, total):
+                nonlocal last_percent_sent
+                percent = current / total * 100
+                current_percent = int(percent)
+
+                if current_percent > last_percent_sent:
+                    bar = progress_bar(percent)
+                    progress_dispatcher.post(
+                        event.client,
+                        upload_msg.chat_id,
+                        upload_msg.id,
+                        f"📤 ᴜᴘʟᴏᴀᴅɪɴɢ ғɪʟᴇ {file_index}/{len(folder_data)}:\n\nғɪʟᴇ ɴᴀᴍᴇ: {filename}\n\nᴘʀᴏᴄᴇss:\n{bar} {percent:.1f}%"
+                    )
+                    last_percent_sent = current_percent
+
+            try:
+                # Upload to user with progress callback
+                upload_start = time.monotonic()
+                try:
+                    sent_message = await upload_file(
+                        client=event.client,
+                        chat_id=event.chat_id,
+                        file_path=item["uploaded_file"] or item["file_path"],
+                        thumb_path=item["thumb"],
+                        caption=item["caption"],
+                        is_video=item["is_video"],
+                        media_info=item["media_info"],
+                        probed=item["probed"],
+                        progress_callback=progress_callback
+                    )
+                finally:
+                    upload_scheduler.release(user_id, upload_slot)
+                upload_time = time.monotonic() - upload_start
+                observe_phase("upload", upload_time, item["filesize"])
+                trace.add("upload", upload_time, file=file_index, size=item["filesize"])
+                item["sent_message"] = sent_message
+                await deletion_scheduler.schedule(event.chat_id, sent_message.id, DELETE_AFTER)
+
+                # Update upload message to completion
+                await progress_dispatcher.discard(upload_msg.chat_id, upload_msg.id)
+                await event.client.edit_message(
+                    upload_msg.chat_id,
+                    upload_msg.id,
+                    f"✅ ғɪʟᴇ {file_index}/{len(folder_data)} ᴜᴘʟᴏᴀᴅᴇᴅ!"
+                )
+                await asyncio.sleep(2)
+                try:
+                    await upload_msg.delete()
+                except:
+                    pass
+
+                record_success()
+                item["status"] = "uploaded"
+                await job_store.checkpoint(job_id, file_index)
+
+            except Exception as e:
+                trace.add("upload", time.monotonic() - upload_start, file=file_index, error=type(e).__name__)
+                await progress_dispatcher.discard(upload_msg.chat_id, upload_msg.id)
+                await event.client.edit_message(
+                    upload_msg.chat_id,
+                    upload_msg.id,
+                    f"❌ Upload failed: {str(e)}"
+                )
+                item["status"] = "failed"
+                record_failure()
+
+            # Cleanup files after upload
+            cleanup(item)
+
+        async def mirror_stage(item):
+            if item["status"] != "uploaded":
+                return
+
+            # Mirror to channel by forwarding without forward tag
+            mirror_message = None
+            if MIRROR_CHANNEL_ID:
+                try:
+                    # Forward the message directly to mirror channel
+                    mirror_message = await event.client.forward_messages(
+                        entity=MIRROR_CHANNEL_ID,
+                        messages=item["sent_message"],
+                        drop_author=True
+                    )
+                except Exception as e:
+                    logger.error(f"Mirror error: {e}")
+                    if LOG_CHANNEL_ID:
                         try:
-                            await upload_msg.delete()
+                            await event.client.send_message(
+                                LOG_CHANNEL_ID,
+                                f"❌ Mirror failed for {item['filename']}\nError: {str(e)}"
+                            )
                         except:
                             pass
-                        
-                        # Update stats
-                        await stats_collection.update_one({}, {
-                            "$inc": {
-                                "total_downloads": 1,
-                                "successful_downloads": 1
-                            }
-                        })
-                        
-                        # Update user download count
-                        await users_collection.update_one(
-                            {"_id": user.id},
-                            {"$inc": {"download_count": 1}}
-                        )
-                        
-                        successful_files += 1
-
-                        # Mirror to channel by forwarding without forward tag
-                        if MIRROR_CHANNEL_ID:
-                            try:
-        # Forward the message directly to mirror channel
-                                await event.client.forward_messages(
-                                    entity=MIRROR_CHANNEL_ID,
-                                    messages=sent_message,
-                                    drop_author=True
-                                )
-                            except Exception as e:
-                                logger.error(f"Mirror error: {e}")
-                                if LOG_CHANNEL_ID:
-                                    try:
-                                        await event.client.send_message(
-                                            LOG_CHANNEL_ID,
-                                            f"❌ Mirror failed for {filename}\nError: {str(e)}"
-                                        )
-                                    except:
-                                        pass
 
-                    except Exception as e:
-                        await event.client.edit_message(
-                            upload_msg.chat_id,
-                            upload_msg.id,
-                            f"❌ Upload failed: {str(e)}"
-                        )
-                        await stats_collection.update_one({}, {
-                            "$inc": {
-                                "total_downloads": 1,
-                                "failed_downloads": 1
-                            }
-                        })
-                        failed_files += 1
-
-                    # Cleanup files after upload
-                    for path in [file_path, thumb_path]:
-                        if path and os.path.exists(path):
-                            try:
-                                os.remove(path)
-                            except Exception as e:
-                                logger.error(f"Error deleting file {path}: {e}")
-
-            # Final folder status
-            if successful_files > 0 or failed_files > 0 or skipped_files > 0:
-                status_msg = f"✅ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴏᴍᴘʟᴇᴛᴇ!\n\nsᴜᴄᴄᴇss: {successful_files}\nғᴀɪʟᴇᴅ: {failed_files}\nsᴋɪᴘᴘᴇᴅ: {skipped_files}"
-                await msg.edit(status_msg, buttons=None)
-            else:
-                await msg.edit("❌ ᴀʟʟ ᴅᴏᴡɴʟᴏᴀᴅs ғᴀɪʟᴇᴅ", buttons=None)
+            if item["cache_key"]:
+                await content_cache.store(item["cache_key"], item["sent_message"], mirror_message)
+
+        items = [
+            {
+                "index": file_index,
+                "file_data": file_data,
+                "cache_key": file_key(share_key, file_data) if share_key else None,
+                "cached": None,
+                "status": None,
+                "uploaded_file": None,
+                "mime_type": None,
+                "reserved": None,
+                "is_video": False,
+                "media_info": None,
+                "probed": False,
+                "thumb_task": None,
+                "thumb": None
+            }
+            for file_index, file_data in enumerate(folder_data, 1)
+        ]
+        # Files a previous run of this job already sent
+        for item in items:
+            if item["index"] in delivered:
+                item["status"] = "delivered"
+                successful_files += 1
 
+        # Next file downloads while the current one is probed and uploaded; delivery keeps folder order
+        await run_pipeline(
+            items,
+            [
+                (resolve_stage, 1, False),
+                (download_stage, PIPELINE_DOWNLOADS, False),
+                (probe_stage, PIPELINE_PROBES, False),
+                (upload_stage, 1, True),
+                (mirror_stage, 1, True)
+            ],
+            window=PIPELINE_WINDOW
+        )
+
+        if job_canceled:
+            final_state = "canceled"
+            await final_status("❌ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴀɴᴄᴇʟᴇᴅ.")
+            return
+
+        # Final folder status
+        final_state = "done"
+        if successful_files > 0 or failed_files > 0 or skipped_files > 0:
+            status_msg = f"✅ ᴅᴏᴡɴʟᴏᴀᴅ ᴄᴏᴍᴘʟᴇᴛᴇ!\n\nsᴜᴄᴄᴇss: {successful_files}\nғᴀɪʟᴇᴅ: {failed_files}\nsᴋɪᴘᴘᴇᴅ: {skipped_files}"
+            await final_status(status_msg)
+        else:
+            await final_status("❌ ᴀʟʟ ᴅᴏᴡɴʟᴏᴀᴅs ғᴀɪʟᴇᴅ")
+
+    except Exception as e:
+        final_state = "failed"
+        logger.error(f"Download task failed: {e}")
+        try:
+            await final_status(f"❌ ᴅᴏᴡɴʟᴏᴀᴅ ғᴀɪʟᴇᴅ: {str(e)[:200]}")
+        except:
+            pass
+    finally:
+        tracer.finish(trace, final_state or "interrupted")
+        # Clear from active downloads
+        active_downloads.pop(job_id, None)
+        for item in items:
+            if item["reserved"] is not None:
+                scratch.release(item["reserved"])
+        scratch.remove_job(job_id)
+        if final_state:
+            await job_store.set_state(job_id, final_state)
+
+async def handle_message(event):
+    text = event.raw_text.strip()
+    if not TERABOX_LINK_REGEX.search(text):
+        return
+
+    if not await check_membership(event):
+        buttons = [[Button.url("ᴊᴏɪɴ ᴄʜᴀɴɴᴇʟ", f"https://t.me/{CHANNEL_USER}")]]
+        try:
+            await event.reply(
+                "🔒 ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ ᴛᴏ ᴜsᴇ ᴛʜɪs ʙᴏᴛ.",
+                buttons=buttons)
         except Exception as e:
-            logger.error(f"Download task failed: {e}")
-            for path in [file_path, thumb_path]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
-            try:
-                await msg.edit(f"❌ ᴅᴏᴡɴʟᴏᴀᴅ ғᴀɪʟᴇᴅ: {str(e)[:200]}", buttons=None)
-            except:
-                pass
-        finally:
-            # Clear from active downloads
-            if user_id in active_downloads:
-                del active_downloads[user_id]
+            logger.error(f"Membership check reply error: {e}")
+        return
+
+    user = await event.get_sender()
+    # Every link is its own job, so cancelling one never touches another from the same user
+    job_id = uuid.uuid4().hex[:8]
+    try:
+        # Create cancel button
+        cancel_button = Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")
+        msg = await event.reply("🔗 ɢᴇᴛᴛɪɴɢ ᴅᴏᴡɴʟᴏᴀᴅ ʟɪɴᴋ...", buttons=[[cancel_button]])
+    except Exception as e:
+        logger.error(f"Error sending initial message: {e}")
+        return
+
+    # Create cancel event for this specific download
+    cancel_event = asyncio.Event()
+    
+    # Add to active downloads
+    active_downloads[job_id] = cancel_event
+    await job_store.create(job_id, user.id, user.first_name, event.chat_id, event.id, text)
 
     # Start download task
-    asyncio.create_task(download_task())
+    asyncio.create_task(download_task(event, user, msg, text, job_id, cancel_event))
+
+class JobOrigin:
+    """Stands in for the NewMessage event of a job resumed after a restart"""
+
+    def __init__(self, client, chat_id, sender_id, message_id):
+        self.client = client
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.id = message_id
+
+    async def reply(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, reply_to=self.id, **kwargs)
+
+async def resume_job(client, job):
+    origin = JobOrigin(client, job["chat_id"], job["user_id"], job["message_id"])
+    user = SimpleNamespace(id=job["user_id"], first_name=job["first_name"], username=None)
+    job_id = job["_id"]
+    try:
+        cancel_button = Button.inline("❌ ᴄᴀɴᴄᴇʟ", f"cancel_{user.id}_{job_id}")
+        msg = await origin.reply("♻️ ʀᴇsᴜᴍɪɴɢ ʏᴏᴜʀ ᴅᴏᴡɴʟᴏᴀᴅ...", buttons=[[cancel_button]])
+    except Exception as e:
+        logger.error(f"Error resuming job {job_id}: {e}")
+        await job_store.set_state(job_id, "failed")
+        return
+
+    cancel_event = asyncio.Event()
+    active_downloads[job_id] = cancel_event
+    asyncio.create_task(download_task(origin, user, msg, job["link"], job_id, cancel_event, delivered=set(job.get("delivered", []))))
 
 async def cancel_handler(event):
     try:
-        user_id = int(event.data.decode('utf-8').split('_')[1])
+        _, user_id, job_id = event.data.decode('utf-8').split('_')
+        user_id = int(user_id)
     except:
         await event.answer("Invalid request!")
         return
@@ -943,16 +1361,20 @@ async def cancel_handler(event):
         await event.answer("ʏᴏᴜ ᴄᴀɴ ᴏɴʟʏ ᴄᴀɴᴄᴇʟ ʏᴏᴜʀ ᴏᴡɴ ᴅᴏᴡɴʟᴏᴀᴅs!")
         return
         
-    if user_id in active_downloads:
-        active_downloads[user_id].set()
+    if job_id in active_downloads:
+        active_downloads[job_id].set()
         await event.answer("ᴄᴜʀʀᴇɴᴛ ғɪʟᴇ ᴄᴀɴᴄᴇʟʟᴀᴛɪᴏɴ ʀᴇǫᴜᴇsᴛᴇᴅ!")
     else:
         await event.answer("ɴᴏ ᴀᴄᴛɪᴠᴇ ᴅᴏᴡɴʟᴏᴀᴅ ᴛᴏ ᴄᴀɴᴄᴇʟ!")
 
 async def main():
+    global upload_pool
     mimetypes.init()
     client = TelegramClient('bot_session', API_ID, API_HASH)
     await client.start(bot_token=BOT_TOKEN)
+    upload_pool = SenderPool(client, size=UPLOAD_CONNECTIONS)
+    scratch.init()
+    thumbnail_cache.init()
     await init_database()
     logger.info("Database initialized successfully")
     
@@ -960,13 +1382,45 @@ async def main():
     client.add_event_handler(broadcast_command, events.NewMessage(pattern='/broadcast'))
     client.add_event_handler(status_command, events.NewMessage(pattern='/status'))
     client.add_event_handler(astatus_command, events.NewMessage(pattern='/astatus'))
+    client.add_event_handler(perf_command, events.NewMessage(pattern='/perf'))
     client.add_event_handler(handle_message, events.NewMessage())
-    client.add_event_handler(cancel_handler, events.CallbackQuery(pattern=r'cancel_\d+'))
+    client.add_event_handler(membership_cache.on_chat_action, events.ChatAction(chats=CHANNEL_ID))
+    client.add_event_handler(cancel_handler, events.CallbackQuery(pattern=r'cancel_\d+_\w+'))
     # Add menu callback handler
     client.add_event_handler(menu_callback, events.CallbackQuery(pattern=r'home|about_bot|help_again'))
     
+    asyncio.create_task(progress_dispatcher.run())
+    asyncio.create_task(stats.run())
+    asyncio.create_task(tracer.run())
+    # Delete delivered files as they come due, including those scheduled before a restart
+    asyncio.create_task(deletion_scheduler.run(client))
+    # Pick up jobs a previous process left unfinished
+    asyncio.create_task(job_store.run(lambda job: resume_job(client, job)))
+    # Loop lag and the gauges /metrics serves, sampled here rather than from the web thread
+    asyncio.create_task(watch_event_loop([
+        (QUEUE_DEPTH, lambda: scheduler.waiting),
+        (ACTIVE_SLOTS, lambda: scheduler.active),
+        (UPLOAD_QUEUE_DEPTH, lambda: upload_scheduler.waiting),
+        (UPLOAD_SLOTS, lambda: upload_scheduler.active),
+        (ACTIVE_DOWNLOADS, lambda: len(active_downloads))
+    ], interval=LOOP_LAG_INTERVAL))
+
+    # Docker stops the container with SIGTERM; disconnecting lets the finally below flush
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.ensure_future(client.disconnect())
+        )
+    except NotImplementedError:
+        pass  # No signal handlers on Windows event loops
+
     logger.info("Bot is running...")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await stats.flush()
+        await tracer.flush()
+        await resolver.close()
+        await upload_pool.close()
 
 if __name__ == "__main__":
     keep_alive()
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import logging
+import datetime
+from pymongo import UpdateOne
+from telethon.errors import FloodWaitError, UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError
+from metrics import flood_wait
+
+logger = logging.getLogger(__name__)
+
+UNREACHABLE_ERRORS = (UserIsBlockedError, InputUserDeactivatedError, PeerIdInvalidError)
+
+
+class TokenBucket:
+    """Allows rate acquisitions per second on average, bursts up to capacity, and full stops on demand"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Broadcaster:
+    """Forwards one message to every user, checkpointing progress in MongoDB
+
+    Users are read in _id order a batch at a time and sent by a pool of workers under a
+    shared rate limit. After each batch the last _id and the counters are saved, so an
+    interrupted or cancelled broadcast can pick up from there.
+    """
+
+    def __init__(self, rate=25, workers=20, batch_size=500, retries=3):
+        self.rate = rate
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.collection = None
+        self.users_collection = None
+        self.blocked_collection = None
+        self.current = None
+        self._cancel = asyncio.Event()
+
+    async def init(self, db, users_collection, blocked_collection):
+        self.collection = db["broadcasts"]
+        self.users_collection = users_collection
+        self.blocked_collection = blocked_collection
+
+    @property
+    def running(self):
+        return self.current is not None
+
+    def cancel(self):
+        if not self.running:
+            return False
+        self._cancel.set()
+        return True
+
+    async def create(self, source_chat_id, source_message_id):
+        doc = {
+            "_id": f"{source_chat_id}_{source_message_id}_{int(time.time())}",
+            "source_chat_id": source_chat_id,
+            "source_message_id": source_message_id,
+            "state": "running",
+            "last_id": None,
+            "counts": {"total": 0, "success": 0, "failed": 0, "blocked": 0},
+            "created_at": datetime.datetime.now()
+        }
+        await self.collection.insert_one(doc)
+        return doc
+
+    async def find_resumable(self):
+        """The latest broadcast that was cancelled or cut short by a restart"""
+        return await self.collection.find_one(
+            {"state": {"$in": ["running", "canceled"]}},
+            sort=[("created_at", -1)]
+        )
+
+    async def _send(self, client, broadcast, user_id, counts, blocked, newly_blocked, bucket):
+        for attempt in range(self.retries):
+            await bucket.acquire()
+            try:
+                await client.forward_messages(
+                    user_id,
+                    broadcast["source_message_id"],
+                    from_peer=broadcast["source_chat_id"]
+                )
+                counts["success"] += 1
+                return
+            except FloodWaitError as e:
+                logger.warning(f"Broadcast flood wait: {e.seconds}s")
+                flood_wait("broadcast", e.seconds)
+                bucket.pause(e.seconds)
+            except Exception as e:
+                if isinstance(e, UNREACHABLE_ERRORS) or "bot was blocked" in str(e).lower():
+                    counts["blocked"] += 1
+                    blocked.add(user_id)
+                    newly_blocked.append(user_id)
+                else:
+                    counts["failed"] += 1
+                    logger.error(f"Failed to send to {user_id}: {str(e)}")
+                return
+        counts["failed"] += 1
+
+    async def run(self, client, broadcast, on_progress=None):
+        """Send broadcast to every user after its checkpoint; returns its final state"""
+        self.current = broadcast
+        self._cancel.clear()
+        counts = broadcast["counts"]
+        last_id = broadcast["last_id"]
+        bucket = TokenBucket(self.rate)
+        state = "running"
+
+        try:
+            blocked = set()
+            async for doc in self.blocked_collection.find({}, {"user_id": 1, "_id": 0}):
+                blocked.add(doc["user_id"])
+
+            while state == "running":
+                query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+                batch = await self.users_collection.find(query, {"_id": 1}).sort("_id", 1).limit(self.batch_size).to_list(length=self.batch_size)
+                if not batch:
+                    state = "done"
+                    break
+
+                queue = asyncio.Queue()
+                for position, doc in enumerate(batch):
+                    queue.put_nowait((position, doc["_id"]))
+                newly_blocked = []
+
+                async def worker():
+                    while not queue.empty() and not self._cancel.is_set():
+                        _, user_id = queue.get_nowait()
+                        counts["total"] += 1
+                        if user_id in blocked:
+                            counts["blocked"] += 1
+                            continue
+                        await self._send(client, broadcast, user_id, counts, blocked, newly_blocked, bucket)
+
+                await asyncio.gather(*[worker() for _ in range(self.workers)])
+
+                if queue.empty():
+                    last_id = batch[-1]["_id"]
+                else:
+                    # Users are taken in order, so everything before the first one left was sent
+                    first_left, _ = queue.get_nowait()
+                    if first_left:
+                        last_id = batch[first_left - 1]["_id"]
+                if self._cancel.is_set():
+                    state = "canceled"
+
+                if newly_blocked:
+                    now = datetime.datetime.now()
+                    await self.blocked_collection.bulk_write([
+                        UpdateOne({"user_id": user_id}, {"$set": {"blocked_at": now}}, upsert=True)
+                        for user_id in newly_blocked
+                    ], ordered=False)
+                await self.collection.update_one(
+                    {"_id": broadcast["_id"]},
+                    {"$set": {"last_id": last_id, "counts": counts, "state": state}}
+                )
+                if on_progress is not None:
+                    await on_progress(counts)
+
+            await self.collection.update_one(
+                {"_id": broadcast["_id"]},
+                {"$set": {"state": state, "counts": counts, "finished_at": datetime.datetime.now()}}
+            )
+            return state
+        finally:
+            self.current = None
@@ -0,0 +1,127 @@
+import logging
+import datetime
+from telethon.errors import FileReferenceExpiredError, RPCError
+from telethon.types import InputDocument, InputPhoto
+
+logger = logging.getLogger(__name__)
+
+
+def file_key(share_key, file_data):
+    """Identity of one file inside a share: fs_id when the API gives one, else name and size"""
+    fs_id = file_data.get("fs_id") or file_data.get("fsid")
+    if fs_id:
+        return f"{share_key}/{fs_id}"
+    return f"{share_key}/{file_data.get('file_name', 'file')}:{int(file_data.get('sizebytes', 0) or 0)}"
+
+
+def media_reference(message):
+    """Serializable reference to the document or photo attached to a sent message"""
+    if message is None:
+        return None
+    if message.document:
+        media, kind = message.document, "document"
+    elif message.photo:
+        media, kind = message.photo, "photo"
+    else:
+        return None
+    return {
+        "kind": kind,
+        "id": media.id,
+        "access_hash": media.access_hash,
+        "file_reference": media.file_reference
+    }
+
+
+def input_media(ref):
+    cls = InputPhoto if ref["kind"] == "photo" else InputDocument
+    return cls(id=ref["id"], access_hash=ref["access_hash"], file_reference=bytes(ref["file_reference"]))
+
+
+class ContentCache:
+    """MongoDB index of files already delivered, re-sent by their Telegram media reference"""
+
+    def __init__(self, ttl=30 * 86400):
+        self.ttl = ttl
+        self.collection = None
+
+    async def init(self, db):
+        self.collection = db["file_cache"]
+        try:
+            await self.collection.create_index("cached_at", expireAfterSeconds=self.ttl)
+        except Exception as e:
+            logger.warning(f"File cache index error: {e}")
+
+    async def store(self, key, message, mirror_message=None):
+        ref = media_reference(message)
+        if self.collection is None or not ref:
+            return
+        doc = {"media": ref, "cached_at": datetime.datetime.now()}
+        if mirror_message is not None:
+            doc["mirror"] = {"chat_id": mirror_message.chat_id, "message_id": mirror_message.id}
+        try:
+            await self.collection.replace_one({"_id": key}, doc, upsert=True)
+        except Exception as e:
+            logger.warning(f"File cache store error: {e}")
+
+    async def evict(self, key):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.delete_one({"_id": key})
+        except Exception as e:
+            logger.warning(f"File cache evict error: {e}")
+
+    async def _refresh(self, client, key, doc):
+        """Fetch a fresh file_reference from the mirrored copy, if there is one"""
+        mirror = doc.get("mirror")
+        if not mirror:
+            return None
+        try:
+            message = await client.get_messages(mirror["chat_id"], ids=mirror["message_id"])
+        except Exception as e:
+            logger.warning(f"File cache refresh error for {key}: {e}")
+            return None
+        ref = media_reference(message)
+        if not ref:
+            return None
+        await self.collection.update_one({"_id": key}, {"$set": {"media": ref}})
+        return ref
+
+    async def get(self, key):
+        if self.collection is None:
+            return None
+        try:
+            return await self.collection.find_one({"_id": key})
+        except Exception as e:
+            logger.warning(f"File cache lookup error: {e}")
+            return None
+
+    async def send(self, client, chat_id, key, caption, doc=None):
+        """Re-send a cached file; returns the sent message or None on a miss"""
+        if doc is None:
+            doc = await self.get(key)
+        if not doc:
+            return None
+
+        ref = doc["media"]
+        for attempt in range(2):
+            try:
+                sent_message = await client.send_file(chat_id, input_media(ref), caption=caption)
+                logger.info(f"Served {key} from file cache")
+                return sent_message
+            except FileReferenceExpiredError:
+                if attempt == 0:
+                    ref = await self._refresh(client, key, doc)
+                    if ref:
+                        continue
+                break
+            except RPCError as e:
+                logger.warning(f"Cached media for {key} rejected: {e}")
+                break
+            except Exception as e:
+                # Network trouble is not a reason to drop the entry
+                logger.warning(f"File cache send error for {key}: {e}")
+                return None
+
+        await self.evict(key)
+        return None
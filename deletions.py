@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import datetime
+from telethon.errors import FloodWaitError
+from metrics import flood_wait
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH = 100  # Message ids Telegram accepts per delete_messages call
+
+
+class DeletionScheduler:
+    """Deletes delivered messages once they are due, from a MongoDB queue that outlives restarts
+
+    One loop takes whatever is due, groups it per chat and deletes each group with a
+    single delete_messages call.
+    """
+
+    def __init__(self, poll_interval=30, fetch_limit=1000):
+        self.poll_interval = poll_interval
+        self.fetch_limit = fetch_limit
+        self.collection = None
+        self._wakeup = asyncio.Event()
+
+    async def init(self, db):
+        self.collection = db["scheduled_deletions"]
+        try:
+            await self.collection.create_index("due_at")
+        except Exception as e:
+            logger.warning(f"Deletion index error: {e}")
+
+    async def schedule(self, chat_id, message_id, delay):
+        if self.collection is None:
+            return
+        due_at = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        try:
+            await self.collection.insert_one({"chat_id": chat_id, "message_id": message_id, "due_at": due_at})
+        except Exception as e:
+            logger.warning(f"Failed to schedule deletion of message {message_id} in chat {chat_id}: {e}")
+            return
+        if delay < self.poll_interval:
+            self._wakeup.set()
+
+    async def _delete_due(self, client):
+        """Delete one batch of due messages; returns how many were handled"""
+        docs = await self.collection.find(
+            {"due_at": {"$lte": datetime.datetime.now()}}
+        ).sort("due_at", 1).limit(self.fetch_limit).to_list(length=self.fetch_limit)
+        if not docs:
+            return 0
+
+        chats = {}
+        for doc in docs:
+            chats.setdefault(doc["chat_id"], []).append(doc)
+
+        for chat_id, chat_docs in chats.items():
+            for start in range(0, len(chat_docs), DELETE_BATCH):
+                batch = chat_docs[start:start + DELETE_BATCH]
+                message_ids = [doc["message_id"] for doc in batch]
+                try:
+                    await client.delete_messages(chat_id, message_ids)
+                    logger.info(f"Deleted {len(message_ids)} messages in chat {chat_id}")
+                except FloodWaitError:
+                    # Leave the rest queued for the next round
+                    raise
+                except Exception as e:
+                    logger.warning(f"Failed to delete messages {message_ids} in chat {chat_id}: {e}")
+                await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        return len(docs)
+
+    async def _next_delay(self):
+        doc = await self.collection.find_one({}, sort=[("due_at", 1)], projection={"due_at": 1})
+        if not doc:
+            return self.poll_interval
+        wait = (doc["due_at"] - datetime.datetime.now()).total_seconds()
+        return min(max(wait, 0), self.poll_interval)
+
+    async def run(self, client):
+        """Delete due messages until cancelled"""
+        while True:
+            delay = self.poll_interval
+            try:
+                if self.collection is not None:
+                    if await self._delete_due(client) < self.fetch_limit:
+                        delay = await self._next_delay()
+                    else:
+                        delay = 0
+            except FloodWaitError as e:
+                logger.warning(f"Deletion flood wait: {e.seconds}s")
+                flood_wait("deletions", e.seconds)
+                delay = e.seconds
+            except Exception as e:
+                logger.error(f"Deletion loop error: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,205 @@
+import os
+import re
+import queue
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONTENT_RANGE_REGEX = re.compile(r"bytes\s+\d+-\d+/(\d+)")
+BUFFER_SIZE = 1024 * 1024
+BUFFERS = 4
+
+
+async def probe_ranges(session, url):
+    """Return (total_size, content_type) if the server honours byte ranges, else (None, content_type)"""
+    try:
+        async with session.get(url, headers={"Range": "bytes=0-0"}) as response:
+            content_type = response.headers.get('Content-Type', '').lower()
+            if response.status != 206:
+                return None, content_type
+            match = CONTENT_RANGE_REGEX.match(response.headers.get('Content-Range', ''))
+            if not match:
+                return None, content_type
+            return int(match.group(1)), content_type
+    except Exception as e:
+        logger.warning(f"Range probe failed: {e}")
+        return None, ''
+
+
+def preallocate(file_path, size):
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+    return fd
+
+
+class SinkCursor:
+    """Sequential writer at one position of a DownloadSink, filling one pooled buffer at a time"""
+
+    def __init__(self, sink, offset):
+        self.sink = sink
+        self.offset = offset
+        self._buffer = None
+        self._filled = 0
+
+    @property
+    def position(self):
+        """Offset just past the last byte accepted, flushed or not"""
+        return self.offset + self._filled
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._buffer is None:
+                self._buffer = await self.sink._take()
+                self._filled = 0
+            count = min(len(view), len(self._buffer) - self._filled)
+            self._buffer[self._filled:self._filled + count] = view[:count]
+            self._filled += count
+            view = view[count:]
+            if self._filled == len(self._buffer):
+                self.flush()
+
+    def flush(self):
+        if self._buffer is None:
+            return
+        self.sink._submit(self._buffer, self._filled, self.offset)
+        self.offset += self._filled
+        self._buffer = None
+        self._filled = 0
+
+
+class DownloadSink:
+    """Writes a download through a fixed pool of reusable buffers and a single writer thread
+
+    Incoming chunks are copied into pooled buffers; full buffers are written with pwrite by
+    the writer thread, which hands them back for reuse. A download therefore holds at most
+    buffers * buffer_size bytes, and reading waits for the disk when all buffers are queued.
+    """
+
+    def __init__(self, file_path, buffer_size=BUFFER_SIZE, buffers=BUFFERS):
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.buffers = buffers
+        self.error = None
+        self._fd = None
+        self._free = None
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._loop = None
+
+    def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._free = asyncio.Queue()
+        for _ in range(self.buffers):
+            self._free.put_nowait(bytearray(self.buffer_size))
+        self._fd = os.open(self.file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._thread = threading.Thread(target=self._writer, name=f"sink-{os.path.basename(self.file_path)}", daemon=True)
+        self._thread.start()
+        return self
+
+    def cursor(self, offset=0):
+        return SinkCursor(self, offset)
+
+    def _writer(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            buffer, count, offset = job
+            if self.error is None:
+                try:
+                    view = memoryview(buffer)[:count]
+                    while view:
+                        written = os.pwrite(self._fd, view, offset)
+                        view = view[written:]
+                        offset += written
+                except Exception as e:
+                    self.error = e
+            self._loop.call_soon_threadsafe(self._free.put_nowait, buffer)
+
+    async def _take(self):
+        if self.error is not None:
+            raise self.error
+        return await self._free.get()
+
+    def _submit(self, buffer, count, offset):
+        if self.error is not None:
+            raise self.error
+        self._jobs.put((buffer, count, offset))
+
+    async def close(self, size=None):
+        """Wait for queued writes, optionally cut the file to size, and raise any write error"""
+        if self._thread is None:
+            return
+        self._jobs.put(None)
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+        try:
+            if self.error is None and size is not None:
+                os.ftruncate(self._fd, size)
+        finally:
+            os.close(self._fd)
+        if self.error is not None:
+            raise self.error
+
+
+async def _fetch_segment(session, url, cursor, end, progress, index, cancel_event, retries):
+    """Download bytes up to end through cursor, resuming from the last received offset on failure"""
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers={"Range": f"bytes={cursor.position}-{end}"}) as response:
+                if response.status != 206:
+                    raise Exception(f"HTTP Error {response.status} for range {cursor.position}-{end}")
+                async for chunk in response.content.iter_any():
+                    if cancel_event.is_set():
+                        return
+                    await cursor.write(chunk)
+                    progress[index] += len(chunk)
+            if cursor.position > end:
+                cursor.flush()
+                return
+            raise Exception(f"Segment {index} ended early at {cursor.position}/{end + 1}")
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Segment {index} failed (attempt {attempt+1}), retrying from {cursor.position}: {e}")
+            await asyncio.sleep(1 + attempt)
+
+
+async def download_segmented(session, url, file_path, filesize, cancel_event, on_progress,
+                             segments=4, retries=3, buffer_size=BUFFER_SIZE, buffers=BUFFERS):
+    """Fetch a file as concurrent byte ranges written in place into a preallocated file"""
+    segment_size = -(-filesize // segments)
+    ranges = [
+        (start, min(start + segment_size, filesize) - 1)
+        for start in range(0, filesize, segment_size)
+    ]
+    progress = [0] * len(ranges)
+
+    os.close(preallocate(file_path, filesize))
+    # One buffer per segment plus one so a segment can fill while another is written
+    sink = DownloadSink(file_path, buffer_size=buffer_size, buffers=max(buffers, len(ranges) + 1)).open()
+    tasks = [
+        asyncio.create_task(_fetch_segment(session, url, sink.cursor(start), end, progress, index, cancel_event, retries))
+        for index, (start, end) in enumerate(ranges)
+    ]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+            if cancel_event.is_set():
+                raise Exception("Download canceled by user")
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+            await on_progress(sum(progress))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await sink.close()
@@ -0,0 +1,124 @@
+import uuid
+import asyncio
+import logging
+import datetime
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+OPEN_STATES = ["queued", "running"]
+
+
+class JobStore:
+    """Jobs persisted in MongoDB with a lease, so another process (or the next one) can resume them
+
+    A job is leased by the process working on it and the lease is renewed by a heartbeat.
+    Jobs whose lease ran out while still open were abandoned by a crash or a restart.
+    """
+
+    def __init__(self, lease_seconds=120, heartbeat_interval=30, max_attempts=3, keep_finished=7 * 86400):
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.keep_finished = keep_finished
+        self.owner = uuid.uuid4().hex
+        self.collection = None
+        self.active = set()
+
+    async def init(self, db):
+        self.collection = db["jobs"]
+        try:
+            await self.collection.create_index([("state", 1), ("lease_until", 1)])
+            await self.collection.create_index("finished_at", expireAfterSeconds=self.keep_finished)
+        except Exception as e:
+            logger.warning(f"Job index error: {e}")
+
+    def _lease(self):
+        return datetime.datetime.now() + datetime.timedelta(seconds=self.lease_seconds)
+
+    async def create(self, job_id, user_id, first_name, chat_id, message_id, link):
+        self.active.add(job_id)
+        if self.collection is None:
+            return
+        now = datetime.datetime.now()
+        try:
+            await self.collection.insert_one({
+                "_id": job_id,
+                "user_id": user_id,
+                "first_name": first_name,
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "link": link,
+                "state": "queued",
+                "delivered": [],
+                "attempts": 1,
+                "owner": self.owner,
+                "lease_until": self._lease(),
+                "created_at": now,
+                "updated_at": now
+            })
+        except Exception as e:
+            logger.warning(f"Job create error for {job_id}: {e}")
+
+    async def set_state(self, job_id, state):
+        if state not in OPEN_STATES:
+            self.active.discard(job_id)
+        if self.collection is None:
+            return
+        update = {"state": state, "updated_at": datetime.datetime.now()}
+        if state not in OPEN_STATES:
+            update["finished_at"] = update["updated_at"]
+        try:
+            await self.collection.update_one({"_id": job_id}, {"$set": update})
+        except Exception as e:
+            logger.warning(f"Job state error for {job_id}: {e}")
+
+    async def checkpoint(self, job_id, file_index):
+        """Record a delivered file so a resumed job skips it"""
+        if self.collection is None:
+            return
+        try:
+            await self.collection.update_one(
+                {"_id": job_id},
+                {"$addToSet": {"delivered": file_index}, "$set": {"updated_at": datetime.datetime.now()}}
+            )
+        except Exception as e:
+            logger.warning(f"Job checkpoint error for {job_id}: {e}")
+
+    async def claim_expired(self):
+        """Take over one open job whose lease ran out, or return None"""
+        if self.collection is None:
+            return None
+        while True:
+            job = await self.collection.find_one_and_update(
+                {"state": {"$in": OPEN_STATES}, "lease_until": {"$lt": datetime.datetime.now()}},
+                {"$set": {"owner": self.owner, "lease_until": self._lease()}, "$inc": {"attempts": 1}},
+                return_document=ReturnDocument.AFTER
+            )
+            if not job:
+                return None
+            if job["attempts"] > self.max_attempts:
+                logger.warning(f"Giving up on job {job['_id']} after {job['attempts'] - 1} attempts")
+                await self.set_state(job["_id"], "failed")
+                continue
+            self.active.add(job["_id"])
+            return job
+
+    async def run(self, resume):
+        """Renew our leases and hand abandoned jobs to resume(job), forever"""
+        while True:
+            try:
+                if self.active and self.collection is not None:
+                    await self.collection.update_many(
+                        {"_id": {"$in": list(self.active)}, "owner": self.owner},
+                        {"$set": {"lease_until": self._lease()}}
+                    )
+                while True:
+                    job = await self.claim_expired()
+                    if not job:
+                        break
+                    logger.info(f"Resuming job {job['_id']} for user {job['user_id']}")
+                    await resume(job)
+            except Exception as e:
+                logger.error(f"Job heartbeat error: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class KnownUsers:
+    """Ids of registered users kept in memory, so /start only touches MongoDB for new ones
+
+    The set is loaded in the background at startup. Registration is an idempotent upsert,
+    so a user missed while it loads is only written again, never counted twice.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.collection = None
+        self._tasks = set()
+
+    async def init(self, collection):
+        self.collection = collection
+        task = asyncio.create_task(self._warm())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm(self):
+        try:
+            async for doc in self.collection.find({}, {"_id": 1}):
+                self.ids.add(doc["_id"])
+            logger.info(f"Loaded {len(self.ids)} known users")
+        except Exception as e:
+            logger.error(f"Error loading known users: {e}")
+
+    async def _register(self, user, on_new):
+        try:
+            result = await self.collection.update_one(
+                {"_id": user.id},
+                {"$setOnInsert": {
+                    "name": user.first_name,
+                    "username": user.username,
+                    "join_date": datetime.datetime.now(),
+                    "download_count": 0
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error registering user {user.id}: {e}")
+            self.ids.discard(user.id)
+            return
+        if result.upserted_id is not None:
+            await on_new(user)
+
+    def register(self, user, on_new):
+        """Record user in the background unless already known; on_new(user) runs if it was inserted"""
+        if user.id in self.ids or self.collection is None:
+            return
+        self.ids.add(user.id)
+        task = asyncio.create_task(self._register(user, on_new))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,133 @@
+import re
+import time
+import logging
+import datetime
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+SHARE_ID_REGEX = re.compile(r"/(s|folder)/([A-Za-z0-9_-]+)")
+DURATION_REGEX = re.compile(r"^(\d+)([smhd]?)$")
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Drop entries a little before the CDN does so we never hand out a dead link
+EXPIRY_MARGIN = 300
+
+
+def share_id(link):
+    """Return the normalized share ID ("s:<id>" or "folder:<id>") of a TeraBox link"""
+    match = SHARE_ID_REGEX.search(link or "")
+    if not match:
+        return None
+    return f"{match.group(1)}:{match.group(2)}"
+
+
+def link_expiry(url):
+    """Best-effort absolute expiry timestamp of a direct link, or None if unknown"""
+    try:
+        params = parse_qs(urlparse(url).query)
+    except Exception:
+        return None
+
+    expires = (params.get("expires") or [""])[0].lower()
+    if not expires:
+        return None
+    if expires.isdigit() and int(expires) > 1_000_000_000:
+        return float(expires)
+
+    match = DURATION_REGEX.match(expires)
+    if not match:
+        return None
+    duration = int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+    issued = (params.get("time") or params.get("dstime") or [""])[0]
+    start = float(issued) if issued.isdigit() else time.time()
+    return start + duration
+
+
+class LinkCache:
+    """Two-tier (in-process LRU + MongoDB TTL) cache of resolved share links"""
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.collection = None
+        self._entries = OrderedDict()
+
+    async def init(self, db):
+        self.collection = db["resolved_links"]
+        try:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"Resolved link cache index error: {e}")
+
+    def _expiry(self, folder_data):
+        expires_at = time.time() + self.ttl
+        for file_data in folder_data:
+            for key in ("direct_link", "link"):
+                expiry = link_expiry(file_data.get(key) or "")
+                if expiry:
+                    expires_at = min(expires_at, expiry - EXPIRY_MARGIN)
+        return expires_at
+
+    def _remember(self, key, folder_data, expires_at):
+        self._entries[key] = (expires_at, folder_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            expires_at, folder_data = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                return folder_data
+            del self._entries[key]
+
+        if self.collection is None:
+            return None
+        try:
+            doc = await self.collection.find_one({"_id": key})
+        except Exception as e:
+            logger.warning(f"Resolved link cache lookup error: {e}")
+            return None
+        if not doc:
+            return None
+
+        expires_at = doc["expires_at"].replace(tzinfo=datetime.timezone.utc).timestamp()
+        if expires_at <= time.time():
+            return None
+        self._remember(key, doc["folder_data"], expires_at)
+        return doc["folder_data"]
+
+    async def set(self, key, folder_data):
+        expires_at = self._expiry(folder_data)
+        if expires_at <= time.time():
+            return
+        self._remember(key, folder_data, expires_at)
+
+        if self.collection is None:
+            return
+        try:
+            await self.collection.replace_one(
+                {"_id": key},
+                {
+                    "folder_data": folder_data,
+                    "expires_at": datetime.datetime.fromtimestamp(expires_at, datetime.timezone.utc),
+                    "cached_at": datetime.datetime.now()
+                },
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Resolved link cache store error: {e}")
+
+    async def invalidate(self, key):
+        self._entries.pop(key, None)
+        if self.collection is None:
+            return
+        try:
+            await self.collection.delete_one({"_id": key})
+        except Exception as e:
+            logger.warning(f"Resolved link cache invalidate error: {e}")
@@ -0,0 +1,114 @@
+import os
+import json
+import asyncio
+import logging
+from telethon.types import DocumentAttributeVideo
+
+logger = logging.getLogger(__name__)
+
+THUMB_WIDTH = 320  # Telegram shows thumbnails at most 320 px wide
+
+
+def _rotation(stream):
+    rotate = stream.get("tags", {}).get("rotate")
+    if rotate is None:
+        for side_data in stream.get("side_data_list", []):
+            if "rotation" in side_data:
+                rotate = side_data["rotation"]
+                break
+    try:
+        return int(float(rotate or 0)) % 360
+    except ValueError:
+        return 0
+
+
+def parse_probe(data):
+    """Pick width, height, duration, codecs and rotation out of ffprobe JSON output"""
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None:
+        return None
+
+    duration = data.get("format", {}).get("duration") or video.get("duration")
+    info = {
+        "width": int(video.get("width") or 0),
+        "height": int(video.get("height") or 0),
+        "duration": float(duration) if duration else 0.0,
+        "video_codec": video.get("codec_name"),
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "rotation": _rotation(video)
+    }
+    # Players apply the rotation, so report the dimensions as displayed
+    if info["rotation"] in (90, 270):
+        info["width"], info["height"] = info["height"], info["width"]
+    return info
+
+
+def video_attributes(info, supports_streaming=True):
+    return DocumentAttributeVideo(
+        duration=int(round(info["duration"])),
+        w=info["width"],
+        h=info["height"],
+        supports_streaming=supports_streaming
+    )
+
+
+class MediaProber:
+    """Runs ffprobe and ffmpeg asynchronously, at most max_processes at a time"""
+
+    def __init__(self, max_processes=2, timeout=30):
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_processes)
+
+    async def _run(self, *args):
+        """Run a command; returns its stdout, or None if it failed or timed out"""
+        async with self._slots:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+            except Exception as e:
+                logger.error(f"Error starting {args[0]}: {e}")
+                return None
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.warning(f"{args[0]} timed out after {self.timeout}s")
+                return None
+            if process.returncode != 0:
+                return None
+            return stdout
+
+    async def probe(self, file_path):
+        """Video stream details of file_path, or None"""
+        stdout = await self._run(
+            "ffprobe", "-v", "error",
+            "-print_format", "json",
+            "-show_format", "-show_streams",
+            file_path
+        )
+        if not stdout:
+            return None
+        try:
+            return parse_probe(json.loads(stdout))
+        except Exception as e:
+            logger.error(f"Error parsing ffprobe output for {file_path}: {e}")
+            return None
+
+    async def thumbnail(self, file_path, thumb_path, duration=None):
+        """Grab one frame into thumb_path, seeking on the input so nothing before it is decoded"""
+        offset = min(1.0, duration / 2) if duration else 1.0
+        await self._run(
+            "ffmpeg", "-y", "-v", "error",
+            "-ss", f"{offset:.3f}",
+            "-i", file_path,
+            "-frames:v", "1",
+            "-vf", f"scale='min({THUMB_WIDTH},iw)':-2",
+            thumb_path
+        )
+        return os.path.exists(thumb_path)
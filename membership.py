@@ -0,0 +1,51 @@
+import time
+import logging
+from collections import OrderedDict
+from telethon.errors import UserNotParticipantError
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipCache:
+    """Bounded cache of channel membership checks, members kept longer than non-members"""
+
+    def __init__(self, chat_id, positive_ttl=600, negative_ttl=30, max_entries=10000):
+        self.chat_id = chat_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def _remember(self, user_id, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (time.monotonic() + ttl, is_member)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    async def check(self, client, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+        try:
+            await client.get_permissions(self.chat_id, user_id)
+        except UserNotParticipantError:
+            self._remember(user_id, False)
+            return False
+        except Exception as e:
+            # Not cached, the next message asks Telegram again
+            logger.error(f"Membership check error: {e}")
+            return False
+        self._remember(user_id, True)
+        return True
+
+    async def on_chat_action(self, event):
+        """ChatAction handler: forget users who joined or left the channel"""
+        if not (event.user_joined or event.user_added or event.user_left or event.user_kicked):
+            return
+        for user_id in event.user_ids or []:
+            self.invalidate(user_id)
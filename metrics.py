@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Observing is a locked add in memory; the text format is only built when /metrics is scraped
+PHASE_SECONDS = Histogram(
+    "terabot_phase_duration_seconds",
+    "Time spent in one phase of a file",
+    ["phase"],
+    buckets=[0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600]
+)
+PHASE_BYTES = Counter("terabot_phase_bytes_total", "Bytes moved by a phase", ["phase"])
+PHASE_THROUGHPUT = Histogram(
+    "terabot_phase_throughput_bytes_per_second",
+    "Bytes per second of one file in a phase",
+    ["phase"],
+    buckets=[2 ** 16, 2 ** 18, 2 ** 20, 2 ** 21, 2 ** 22, 2 ** 23, 2 ** 24, 2 ** 25, 2 ** 26, 2 ** 27]
+)
+RESOLVER_REQUESTS = Counter(
+    "terabot_resolver_requests_total",
+    "Resolver backend calls by outcome",
+    ["backend", "key", "outcome"]
+)
+RESOLVER_SECONDS = Histogram(
+    "terabot_resolver_request_duration_seconds",
+    "Latency of resolver backend calls",
+    ["backend", "key"],
+    buckets=[0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120]
+)
+FLOOD_WAITS = Counter("terabot_flood_waits_total", "FloodWaitErrors received from Telegram", ["source"])
+FLOOD_WAIT_SECONDS = Counter("terabot_flood_wait_seconds_total", "Seconds Telegram asked us to wait", ["source"])
+LOOP_LAG = Gauge("terabot_event_loop_lag_seconds", "How late the latest event loop probe woke up")
+LOOP_LAG_SECONDS = Histogram(
+    "terabot_event_loop_lag_probe_seconds",
+    "How late event loop probes woke up",
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+)
+QUEUE_DEPTH = Gauge("terabot_download_queue_depth", "Files waiting for a download slot")
+ACTIVE_SLOTS = Gauge("terabot_download_slots_active", "Download slots in use")
+UPLOAD_QUEUE_DEPTH = Gauge("terabot_upload_queue_depth", "Files waiting for an upload slot")
+UPLOAD_SLOTS = Gauge("terabot_upload_slots_active", "Upload slots in use")
+ACTIVE_DOWNLOADS = Gauge("terabot_active_downloads", "Jobs in active_downloads")
+
+
+def observe_phase(phase, seconds, size=0):
+    PHASE_SECONDS.labels(phase).observe(seconds)
+    if size:
+        PHASE_BYTES.labels(phase).inc(size)
+        if seconds > 0:
+            PHASE_THROUGHPUT.labels(phase).observe(size / seconds)
+
+
+def observe_resolver(backend, elapsed, ok):
+    """backend as Resolver.record names it, e.g. "alt" or "rapidapi#2" for the second key"""
+    name, _, key = backend.partition("#")
+    RESOLVER_REQUESTS.labels(name, key, "success" if ok else "failure").inc()
+    RESOLVER_SECONDS.labels(name, key).observe(elapsed)
+
+
+def flood_wait(source, seconds):
+    FLOOD_WAITS.labels(source).inc()
+    FLOOD_WAIT_SECONDS.labels(source).inc(seconds)
+
+
+async def watch_event_loop(samples, interval=1.0):
+    """Measure loop lag every interval and copy samples, (gauge, function) pairs, into their gauges
+
+    Sampling runs on the loop, so the functions may read state the web thread must not touch.
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - start - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+        for gauge, sample in samples:
+            try:
+                gauge.set(sample())
+            except Exception as e:
+                logger.warning(f"Metrics sample error: {e}")
@@ -0,0 +1,84 @@
+import asyncio
+
+_DONE = object()
+
+
+async def run_pipeline(items, stages, queue_size=1, window=None):
+    """Push items through stages connected by bounded queues
+
+    stages is a list of (func, concurrency, ordered). Every item visits every stage
+    (func(item) is awaited); an ordered stage runs one item at a time in the original
+    item order, so later items can finish earlier stages while it waits. window caps
+    how many items are inside the pipeline at once. The first exception raised by a
+    stage cancels the pipeline and is re-raised.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    slots = asyncio.Semaphore(window) if window else None
+
+    async def feed():
+        for seq, item in enumerate(items):
+            if slots:
+                await slots.acquire()
+            await queues[0].put((seq, item))
+        await queues[0].put(_DONE)
+
+    async def forward(stage_index, entry):
+        if stage_index + 1 < len(queues):
+            await queues[stage_index + 1].put(entry)
+        elif slots and entry is not _DONE:
+            slots.release()
+
+    def unordered_stage(stage_index, func, concurrency):
+        remaining = concurrency
+
+        async def worker():
+            nonlocal remaining
+            queue = queues[stage_index]
+            while True:
+                entry = await queue.get()
+                if entry is _DONE:
+                    remaining -= 1
+                    if remaining:
+                        await queue.put(_DONE)  # Let sibling workers see it too
+                    else:
+                        await forward(stage_index, _DONE)
+                    return
+                await func(entry[1])
+                await forward(stage_index, entry)
+
+        return [worker() for _ in range(concurrency)]
+
+    async def ordered_stage(stage_index, func):
+        queue = queues[stage_index]
+        waiting = {}
+        next_seq = 0
+        finished = False
+        while not finished or waiting:
+            if next_seq in waiting:
+                entry = waiting.pop(next_seq)
+                await func(entry[1])
+                await forward(stage_index, entry)
+                next_seq += 1
+                continue
+            if finished:
+                break
+            entry = await queue.get()
+            if entry is _DONE:
+                finished = True
+            else:
+                waiting[entry[0]] = entry
+        await forward(stage_index, _DONE)
+
+    coroutines = [feed()]
+    for stage_index, (func, concurrency, ordered) in enumerate(stages):
+        if ordered:
+            coroutines.append(ordered_stage(stage_index, func))
+        else:
+            coroutines.extend(unordered_stage(stage_index, func, max(1, concurrency)))
+
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
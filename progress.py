@@ -0,0 +1,111 @@
+import time
+import asyncio
+import logging
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+from metrics import flood_wait
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressDispatcher:
+    """Sends progress edits for every job, newest state per message only
+
+    Jobs post the state they want shown; a state not yet sent is replaced by the next
+    one for the same message. Edits go out at most once per chat_interval for a chat
+    and global_rate per second for the bot, and all of them pause on a FloodWaitError.
+    """
+
+    def __init__(self, chat_interval=3.0, global_rate=20):
+        self.chat_interval = chat_interval
+        self.global_interval = 1 / global_rate
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self._pending = {}
+        self._sending = {}
+        self._chat_ready = {}
+        self._next_send = 0
+        self._paused_until = 0
+        self._wakeup = asyncio.Event()
+
+    def post(self, client, chat_id, message_id, text, buttons=None):
+        """Queue text as the next state of a message, superseding one not sent yet"""
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.dropped += 1
+            del self._pending[key]  # Re-insert at the back so busy messages do not starve others
+        self._pending[key] = (client, text, buttons)
+        self._wakeup.set()
+
+    async def discard(self, chat_id, message_id):
+        """Drop the unsent state of a message and wait out an edit in flight, before a final edit"""
+        key = (chat_id, message_id)
+        task = self._sending.get(key)
+        if task:
+            await asyncio.wait([task])
+        if self._pending.pop(key, None) is not None:
+            self.dropped += 1
+
+    async def _send(self, key, client, text, buttons):
+        chat_id, message_id = key
+        try:
+            await client.edit_message(chat_id, message_id, text, buttons=buttons)
+            self.sent += 1
+        except MessageNotModifiedError:
+            pass
+        except FloodWaitError as e:
+            self.flood_waits += 1
+            flood_wait("progress", e.seconds)
+            logger.warning(f"Progress edits flood wait: {e.seconds}s")
+            self._paused_until = time.monotonic() + e.seconds
+            # Retry the state unless a newer one arrived meanwhile
+            self._pending.setdefault(key, (client, text, buttons))
+        except Exception as e:
+            self.failed += 1
+            if "Message is not modified" not in str(e):
+                logger.warning(f"Progress update error: {e}")
+        finally:
+            del self._sending[key]
+            self._wakeup.set()
+
+    def _next_ready(self, now):
+        """The first pending message its chat allows now, or the time one will be allowed"""
+        earliest = None
+        for key in self._pending:
+            if key in self._sending:
+                continue
+            ready = self._chat_ready.get(key[0], 0)
+            if ready <= now:
+                return key, None
+            earliest = ready if earliest is None else min(earliest, ready)
+        return None, earliest
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            delay = None
+            if now < self._paused_until:
+                delay = self._paused_until - now
+            elif now < self._next_send:
+                delay = self._next_send - now
+            else:
+                key, ready = self._next_ready(now)
+                if key:
+                    client, text, buttons = self._pending.pop(key)
+                    self._chat_ready[key[0]] = now + self.chat_interval
+                    self._next_send = now + self.global_interval
+                    self._sending[key] = asyncio.create_task(self._send(key, client, text, buttons))
+                    continue
+                if ready is not None:
+                    delay = ready - now
+
+            # Forget chats that have gone quiet
+            if len(self._chat_ready) > 1000:
+                self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,226 @@
+import time
+import asyncio
+import logging
+from collections import deque
+import aiohttp
+from aiohttp import ClientTimeout
+from metrics import observe_resolver
+
+logger = logging.getLogger(__name__)
+
+ALT_API_URL = "https://lavdya.ninja1.workers.dev/"
+ALT_API_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/119.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache"
+}
+
+
+def alt_folder_data(data):
+    """Convert an alternative API response to the RapidAPI folder_data layout"""
+    return [{
+        "file_name": data['file_name'],
+        "direct_link": data.get('direct_link', ''),
+        "link": data.get('link', ''),
+        "thumbnail": data.get('thumb', ''),
+        "size": data.get('size', ''),
+        "sizebytes": data.get('sizebytes', 0)
+    }]
+
+
+class Resolver:
+    """Turns share links into folder_data over one pooled, keep-alive aiohttp session"""
+
+    def __init__(self, api_keys, rapidapi_host, alt_timeout=120, rapidapi_timeout=60,
+                 retries=10, retry_delay=5, max_connections=100, max_per_host=10, dns_ttl=300,
+                 hedged=True, hedge_delay=3.0, min_hedge_delay=0.5, max_hedge_delay=30.0):
+        self.api_keys = api_keys
+        self.rapidapi_host = rapidapi_host
+        self.rapidapi_url = f"https://{rapidapi_host}/url"
+        self.alt_api_url = ALT_API_URL
+        self.alt_timeout = ClientTimeout(total=alt_timeout)
+        self.rapidapi_timeout = ClientTimeout(total=rapidapi_timeout)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.dns_ttl = dns_ttl
+        self.hedged = hedged
+        self.initial_hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.backend_stats = {}
+        self._session = None
+
+    @property
+    def session(self):
+        # Created lazily so it binds to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def fetch_alt_api(self, link):
+        try:
+            async with self.session.get(
+                self.alt_api_url,
+                params={"url": link},
+                headers=ALT_API_HEADERS,
+                timeout=self.alt_timeout
+            ) as response:
+                if response.status == 200:
+                    data = await response.json(content_type=None)
+                    if isinstance(data, dict) and (data.get('direct_link') or data.get('link')):
+                        return data
+                return None
+        except Exception as e:
+            logger.warning(f"Alternative API error: {str(e)}")
+            return None
+
+    async def fetch_rapidapi(self, link, api_key):
+        async with self.session.get(
+            self.rapidapi_url,
+            params={"url": link},
+            headers={
+                "X-RapidAPI-Key": api_key,
+                "X-RapidAPI-Host": self.rapidapi_host
+            },
+            timeout=self.rapidapi_timeout
+        ) as response:
+            response.raise_for_status()
+            resp_json = await response.json(content_type=None)
+
+        if not resp_json or not isinstance(resp_json, list) or len(resp_json) == 0:
+            raise Exception("Invalid API response")
+        return resp_json
+
+    def record(self, backend, elapsed, ok, on_attempt=None):
+        observe_resolver(backend, elapsed, ok)
+        if on_attempt is not None:
+            on_attempt(backend, elapsed, ok)
+        stats = self.backend_stats.setdefault(
+            backend, {"success": 0, "failure": 0, "latencies": deque(maxlen=100)}
+        )
+        stats["success" if ok else "failure"] += 1
+        if ok:
+            stats["latencies"].append(elapsed)
+
+    @property
+    def hedge_delay(self):
+        """p95 of recent successful resolutions, so hedges only fire for the slow tail"""
+        latencies = sorted(
+            latency
+            for stats in self.backend_stats.values()
+            for latency in stats["latencies"]
+        )
+        if len(latencies) < 10:
+            return self.initial_hedge_delay
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        return min(self.max_hedge_delay, max(self.min_hedge_delay, p95))
+
+    async def _alt_backend(self, link, on_attempt=None):
+        start = time.monotonic()
+        alt_api_data = await self.fetch_alt_api(link)
+        self.record("alt", time.monotonic() - start, bool(alt_api_data), on_attempt)
+        return alt_folder_data(alt_api_data) if alt_api_data else None
+
+    async def _rapidapi_backend(self, link, key_index, cancel_event=None, on_retry=None, on_attempt=None):
+        api_key = self.api_keys[key_index]
+        for retry in range(self.retries):
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            if retry > 0 and on_retry is not None:
+                # A status update that fails is not a failure of the key
+                try:
+                    await on_retry(retry + 1, self.retries, key_index + 1)
+                except Exception as e:
+                    logger.warning(f"Retry status update error: {e}")
+            start = time.monotonic()
+            try:
+                folder_data = await self.fetch_rapidapi(link, api_key)
+                self.record(f"rapidapi#{key_index + 1}", time.monotonic() - start, True, on_attempt)
+                return folder_data
+            except Exception as e:
+                self.record(f"rapidapi#{key_index + 1}", time.monotonic() - start, False, on_attempt)
+                logger.error(f"API key {api_key} failed (attempt {retry+1}): {str(e)}")
+                if retry < 2:
+                    await asyncio.sleep(self.retry_delay)  # Short delay before retry
+        return None
+
+    async def _resolve_sequential(self, link, cancel_event=None, on_retry=None, on_attempt=None):
+        folder_data = await self._alt_backend(link, on_attempt)
+        if folder_data:
+            return folder_data
+
+        for key_index in range(len(self.api_keys)):
+            folder_data = await self._rapidapi_backend(link, key_index, cancel_event, on_retry, on_attempt)
+            if folder_data:
+                return folder_data
+        return None
+
+    async def _resolve_hedged(self, link, cancel_event=None, on_retry=None, on_attempt=None):
+        """Race the alt worker against RapidAPI keys, adding a key every hedge_delay"""
+        pending = {asyncio.create_task(self._alt_backend(link, on_attempt))}
+        next_key = 0
+
+        def launch_key():
+            nonlocal next_key
+            pending.add(asyncio.create_task(
+                self._rapidapi_backend(link, next_key, cancel_event, on_retry, on_attempt)
+            ))
+            next_key += 1
+
+        if self.api_keys:
+            launch_key()
+        cancel_waiter = asyncio.create_task(cancel_event.wait()) if cancel_event is not None else None
+
+        try:
+            while pending:
+                waiting = pending | {cancel_waiter} if cancel_waiter else pending
+                hedge_timeout = self.hedge_delay if next_key < len(self.api_keys) else None
+                done, _ = await asyncio.wait(waiting, timeout=hedge_timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if cancel_waiter in done:
+                    return None
+                for task in done:
+                    pending.discard(task)
+                    if not task.cancelled() and task.exception() is None and task.result():
+                        return task.result()
+
+                # Either the hedge delay elapsed or a backend gave up: bring in the next key
+                if next_key < len(self.api_keys):
+                    launch_key()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if cancel_waiter:
+                cancel_waiter.cancel()
+
+    async def resolve(self, link, cancel_event=None, on_retry=None, on_attempt=None):
+        """Return folder_data for a share link, or None if every backend failed
+
+        on_retry(attempt, attempts, key_number) is called before each RapidAPI retry and
+        on_attempt(backend, elapsed, ok) after each backend request.
+        """
+        if self.hedged:
+            return await self._resolve_hedged(link, cancel_event, on_retry, on_attempt)
+        return await self._resolve_sequential(link, cancel_event, on_retry, on_attempt)
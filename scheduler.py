@@ -0,0 +1,116 @@
+import time
+import asyncio
+from collections import deque
+
+
+class FairScheduler:
+    """Grants download or upload slots one file at a time, round-robin across users
+
+    Each user has a FIFO queue of waiting files; a free slot goes to the next user in
+    rotation that has a waiter and is below per_user running slots.
+    """
+
+    def __init__(self, max_concurrent=3, per_user=1):
+        self.max_concurrent = max_concurrent
+        self.per_user = per_user
+        self.active = 0
+        self._queues = {}
+        self._rotation = deque()
+        self._running = {}
+        self._durations = deque(maxlen=50)
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _dispatch(self):
+        checked = 0
+        while self.active < self.max_concurrent and self._rotation and checked < len(self._rotation):
+            user_id = self._rotation[0]
+            self._rotation.rotate(-1)
+            queue = self._queues.get(user_id)
+            if not queue or self._running.get(user_id, 0) >= self.per_user:
+                checked += 1
+                continue
+            job_id, future = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+                self._rotation.remove(user_id)
+            if future.done():
+                continue
+            self.active += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            future.set_result(time.monotonic())
+            checked = 0
+
+    def _forget(self, user_id, future):
+        queue = self._queues.get(user_id)
+        if not queue:
+            return
+        for entry in list(queue):
+            if entry[1] is future:
+                queue.remove(entry)
+        if not queue:
+            del self._queues[user_id]
+            self._rotation.remove(user_id)
+
+    def position(self, user_id, job_id):
+        """Files granted before this job's next file under round-robin (0 = next in line)"""
+        queue = self._queues.get(user_id)
+        if not queue:
+            return 0
+        index = next((i for i, entry in enumerate(queue) if entry[0] == job_id), len(queue))
+        return index + sum(
+            min(len(other), index + 1)
+            for other_id, other in self._queues.items()
+            if other_id != user_id
+        )
+
+    def eta(self, position):
+        """Rough seconds until a waiter at this position starts, from recent slot hold times"""
+        if not self._durations:
+            return None
+        average = sum(self._durations) / len(self._durations)
+        return (position // self.max_concurrent + 1) * average
+
+    async def acquire(self, user_id, job_id, cancel_event=None, on_wait=None, update_interval=5):
+        """Wait for a slot; returns its start time, or None if cancel_event fired first"""
+        future = asyncio.get_running_loop().create_future()
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._rotation.append(user_id)
+        self._queues[user_id].append((job_id, future))
+        self._dispatch()
+
+        try:
+            while not future.done():
+                if cancel_event is not None and cancel_event.is_set():
+                    self._forget(user_id, future)
+                    return None
+                if on_wait is not None:
+                    position = self.position(user_id, job_id)
+                    await on_wait(position, self.eta(position))
+
+                waiters = [future]
+                if cancel_event is not None:
+                    waiters.append(asyncio.ensure_future(cancel_event.wait()))
+                try:
+                    await asyncio.wait(waiters, timeout=update_interval, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for waiter in waiters[1:]:
+                        waiter.cancel()
+        except BaseException:
+            if future.done():
+                self.release(user_id, future.result())
+            else:
+                self._forget(user_id, future)
+            raise
+        return future.result()
+
+    def release(self, user_id, started):
+        self.active -= 1
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+        self._durations.append(time.monotonic() - started)
+        self._dispatch()
@@ -0,0 +1,29 @@
+import time
+import logging
+from collections import deque
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryLogger(monitoring.CommandListener):
+    """Logs MongoDB commands slower than threshold_ms and keeps the latest ones for /astatus"""
+
+    def __init__(self, threshold_ms=100, keep=20):
+        self.threshold_ms = threshold_ms
+        self.count = 0
+        self.recent = deque(maxlen=keep)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms:
+            return
+        self.count += 1
+        self.recent.append((time.time(), event.command_name, event.database_name, duration_ms))
+        logger.warning(f"Slow MongoDB {event.command_name} on {event.database_name}: {duration_ms:.0f} ms")
+
+    def failed(self, event):
+        pass
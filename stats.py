@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import datetime
+from collections import Counter
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ["total_users", "total_downloads", "successful_downloads", "failed_downloads"]
+
+
+class StatsAggregator:
+    """Counts in memory and writes the accumulated deltas to MongoDB every flush_interval seconds
+
+    totals always includes increments not flushed yet, so it can be shown without a query.
+    Each flush also adds the deltas to hourly and daily rollup documents.
+    """
+
+    def __init__(self, flush_interval=5):
+        self.flush_interval = flush_interval
+        self.totals = Counter()
+        self.stats_collection = None
+        self.users_collection = None
+        self.rollups_collection = None
+        self._pending = Counter()
+        self._user_downloads = Counter()
+        self._rollups = {}
+
+    async def init(self, stats_collection, users_collection, rollups_collection):
+        self.stats_collection = stats_collection
+        self.users_collection = users_collection
+        self.rollups_collection = rollups_collection
+        stats = await stats_collection.find_one({}) or {}
+        self.totals = Counter({name: stats.get(name, 0) for name in COUNTERS}) + self._pending
+        try:
+            await rollups_collection.create_index([("period", 1), ("start", -1)])
+        except Exception as e:
+            logger.warning(f"Stats rollup index error: {e}")
+
+    def incr(self, name, amount=1):
+        self.totals[name] += amount
+        self._pending[name] += amount
+        now = datetime.datetime.now()
+        for period, start in [
+            ("hour", now.replace(minute=0, second=0, microsecond=0)),
+            ("day", now.replace(hour=0, minute=0, second=0, microsecond=0))
+        ]:
+            self._rollups.setdefault((period, start), Counter())[name] += amount
+
+    def user_download(self, user_id):
+        self._user_downloads[user_id] += 1
+
+    async def flush(self):
+        if self.stats_collection is None:
+            return
+        pending, self._pending = self._pending, Counter()
+        user_downloads, self._user_downloads = self._user_downloads, Counter()
+        rollups, self._rollups = self._rollups, {}
+
+        # Deltas of a failed write are kept for the next flush
+        if pending:
+            try:
+                await self.stats_collection.update_one({}, {
+                    "$inc": dict(pending),
+                    "$set": {"last_updated": datetime.datetime.now()}
+                })
+            except Exception as e:
+                logger.error(f"Stats flush error: {e}")
+                self._pending.update(pending)
+
+        if user_downloads:
+            try:
+                await self.users_collection.bulk_write([
+                    UpdateOne({"_id": user_id}, {"$inc": {"download_count": count}})
+                    for user_id, count in user_downloads.items()
+                ], ordered=False)
+            except Exception as e:
+                logger.error(f"User stats flush error: {e}")
+                self._user_downloads.update(user_downloads)
+
+        if rollups:
+            try:
+                await self.rollups_collection.bulk_write([
+                    UpdateOne(
+                        {"_id": f"{period}:{start.isoformat()}"},
+                        {"$inc": dict(counts), "$setOnInsert": {"period": period, "start": start}},
+                        upsert=True
+                    )
+                    for (period, start), counts in rollups.items()
+                ], ordered=False)
+            except Exception as e:
+                logger.error(f"Stats rollup flush error: {e}")
+                for key, counts in rollups.items():
+                    self._rollups.setdefault(key, Counter()).update(counts)
+
+    async def last_hours(self, name, hours=24):
+        """Sum of a counter over the latest hourly rollups, unflushed increments included"""
+        since = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=hours - 1)
+        total = sum(
+            counts[name] for (period, start), counts in self._rollups.items()
+            if period == "hour" and start >= since
+        )
+        async for rollup in self.rollups_collection.find({"period": "hour", "start": {"$gte": since}}, {name: 1}):
+            total += rollup.get(name, 0)
+        return total
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class ScratchStorage:
+    """Owns the download directory: unique per-job paths and a byte budget shared by all jobs
+
+    A file reserves its size before it is downloaded and waits in line while the budget
+    is used up. Files live in a terabot subdirectory that only we write to, so it is
+    swept at startup without touching anything else in the configured directory.
+    """
+
+    def __init__(self, directory="downloads", budget=None):
+        self.directory = os.path.join(os.path.abspath(directory), "terabot")
+        self.budget = budget or None  # Unlimited until init() measures the disk
+        self._default_budget = not budget
+        self.reserved = 0
+        self._waiting = deque()
+
+    def init(self):
+        """Sweep leftovers, then size the default budget from the space that leaves free"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.sweep()
+        if self._default_budget:
+            # Leave a tenth of the disk for everything else
+            self.budget = int(shutil.disk_usage(self.directory).free * 0.9)
+            logger.info(f"Scratch budget {self.budget // (1024 * 1024)} MB in {self.directory}")
+
+    def sweep(self):
+        """Delete whatever a previous process left behind"""
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Could not remove leftover {path}: {e}")
+        if removed:
+            logger.info(f"Removed {removed} leftover scratch entries from {self.directory}")
+
+    def path(self, job_id, index, filename):
+        """A path no other job or file uses that keeps filename as its basename"""
+        file_dir = os.path.join(self.directory, job_id, str(index))
+        os.makedirs(file_dir, exist_ok=True)
+        return os.path.join(file_dir, filename)
+
+    def remove_job(self, job_id):
+        shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+
+    def _fits(self, size):
+        # A file bigger than the whole budget still gets to run, alone
+        if self.budget is None:
+            return True
+        return self.reserved + size <= self.budget or self.reserved == 0
+
+    def _dispatch(self):
+        while self._waiting and self._waiting[0][1].done():
+            self._waiting.popleft()
+        while self._waiting and self._fits(self._waiting[0][0]):
+            size, future = self._waiting.popleft()
+            if future.done():
+                continue
+            self.reserved += size
+            future.set_result(size)
+
+    async def reserve(self, size, cancel_event=None, on_wait=None):
+        """Wait until size bytes fit in the budget; returns the reservation, or None if cancel_event fired"""
+        if not self._waiting and self._fits(size):
+            self.reserved += size
+            return size
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((size, future))
+        if on_wait is not None:
+            await on_wait()
+        waiters = [future]
+        if cancel_event is not None:
+            waiters.append(asyncio.ensure_future(cancel_event.wait()))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release(future.result())
+            future.cancel()
+            raise
+        finally:
+            for waiter in waiters[1:]:
+                waiter.cancel()
+
+        if future.done():
+            return future.result()
+        future.cancel()
+        self._dispatch()
+        return None
+
+    def release(self, size):
+        self.reserved -= size
+        self._dispatch()
@@ -0,0 +1,150 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import logging
+from io import BytesIO
+from collections import OrderedDict
+from aiohttp import ClientTimeout
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+THUMB_MAX_SIDE = 320  # Telegram thumbnail limits
+THUMB_MAX_BYTES = 200 * 1024
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+
+def prepare_thumbnail(data, thumb_path):
+    """Check that data is an image and save it as a JPEG within Telegram's thumbnail limits"""
+    with Image.open(BytesIO(data)) as image:
+        image.verify()
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("RGB")
+        image.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+        for quality in (85, 70, 50):
+            output = BytesIO()
+            image.save(output, "JPEG", quality=quality, optimize=True)
+            if output.tell() <= THUMB_MAX_BYTES:
+                break
+    temp_path = f"{thumb_path}.part"
+    with open(temp_path, "wb") as f:
+        f.write(output.getvalue())
+    os.replace(temp_path, thumb_path)
+    return output.tell()
+
+
+class ThumbnailCache:
+    """API thumbnails fetched ahead of the file they belong to, kept on disk by key in LRU order
+
+    Jobs get their own link or copy of a thumbnail, so evicting it never pulls it from
+    under an upload.
+    """
+
+    def __init__(self, cache_dir="thumb_cache", max_bytes=100 * 1024 * 1024, timeout=15):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.timeout = ClientTimeout(total=timeout)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fetching = {}
+
+    def init(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Rebuild the LRU order from what a previous run left on disk"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".part"):
+                os.remove(path)
+            elif name.endswith(".jpg"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self._size += size
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        path = self._path(key)
+        if path not in self._entries:
+            return None
+        if not os.path.exists(path):
+            self._size -= self._entries.pop(path)
+            return None
+        self._entries.move_to_end(path)
+        return path
+
+    async def _fetch(self, session, key, url):
+        path = self._path(key)
+        try:
+            async with session.get(url, timeout=self.timeout) as response:
+                if response.status != 200:
+                    logger.warning(f"Thumbnail download failed: HTTP {response.status}")
+                    return None
+                if (response.content_length or 0) > MAX_SOURCE_BYTES:
+                    logger.warning(f"Thumbnail for {key} is too large")
+                    return None
+                # read(n) only returns what is buffered, so collect chunks until EOF
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    data.extend(chunk)
+                    if len(data) > MAX_SOURCE_BYTES:
+                        logger.warning(f"Thumbnail for {key} is too large")
+                        return None
+            size = await asyncio.to_thread(prepare_thumbnail, data, path)
+        except Exception as e:
+            logger.warning(f"Thumbnail download failed for {key}: {e}")
+            return None
+
+        if path in self._entries:
+            self._size -= self._entries[path]
+        self._entries[path] = size
+        self._entries.move_to_end(path)
+        self._size += size
+        self._evict()
+        return self.get(key)
+
+    def _checkout(self, path, dest):
+        # No await between get() and here, so eviction cannot run in between; a thumbnail is at
+        # most THUMB_MAX_BYTES, so even the copy fallback is quick enough for the event loop
+        try:
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+        except OSError as e:
+            logger.warning(f"Could not copy thumbnail to {dest}: {e}")
+            return None
+        return dest
+
+    async def _deliver(self, key, fetch, dest):
+        if fetch is not None:
+            # Other jobs may be waiting for the same fetch
+            await asyncio.shield(fetch)
+        path = self.get(key)
+        return self._checkout(path, dest) if path else None
+
+    def prefetch(self, session, key, url, dest):
+        """Start fetching a thumbnail; returns a task resolving to dest, holding the caller's own copy, or None"""
+        fetch = self._fetching.get(key)
+        if fetch is None and not self.get(key):
+            fetch = asyncio.create_task(self._fetch(session, key, url))
+            self._fetching[key] = fetch
+            fetch.add_done_callback(lambda _: self._fetching.pop(key, None))
+        return asyncio.create_task(self._deliver(key, fetch, dest))
@@ -0,0 +1,136 @@
+import time
+import asyncio
+import logging
+import datetime
+from contextlib import contextmanager
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+class Trace:
+    """Timings of one run of a job: a span per phase, offsets and durations in seconds"""
+
+    def __init__(self, job_id, user_id, link):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.link = link
+        self.started_at = datetime.datetime.now()
+        self.attrs = {}
+        self.spans = []
+        self._start = time.monotonic()
+
+    @contextmanager
+    def span(self, phase, file=None, **attrs):
+        """Time the body as phase; the yielded dict takes attributes learned inside it"""
+        span = {"phase": phase, "file": file, "offset": round(time.monotonic() - self._start, 3), **attrs}
+        start = time.monotonic()
+        try:
+            yield span
+        except BaseException as e:
+            span.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            span["duration"] = round(time.monotonic() - start, 3)
+            self.spans.append(span)
+
+    def add(self, phase, duration, file=None, **attrs):
+        """Record a span timed elsewhere, ending now"""
+        offset = round(time.monotonic() - self._start - duration, 3)
+        self.spans.append({"phase": phase, "file": file, "offset": offset, "duration": round(duration, 3), **attrs})
+
+    def document(self, state):
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "link": self.link,
+            "started_at": self.started_at,
+            "duration": round(time.monotonic() - self._start, 3),
+            "state": state,
+            "bytes": sum(span.get("size", 0) for span in self.spans if span["phase"] == "download" and "error" not in span),
+            **self.attrs,
+            "spans": self.spans
+        }
+
+
+class Tracer:
+    """Writes finished traces to a capped collection from a background task
+
+    finish() only queues the document, so a slow or unreachable MongoDB never holds up a job;
+    when the queue is full the trace is dropped.
+    """
+
+    def __init__(self, collection_size=64 * 1024 * 1024, queue_size=1000, batch_size=100):
+        self.collection_size = collection_size
+        self.batch_size = batch_size
+        self.collection = None
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+
+    async def init(self, db):
+        try:
+            await db.create_collection("job_traces", capped=True, size=self.collection_size)
+        except CollectionInvalid:
+            pass  # Already there
+        except Exception as e:
+            logger.warning(f"Trace collection error: {e}")
+        self.collection = db["job_traces"]
+        try:
+            await self.collection.create_index("started_at")
+        except Exception as e:
+            logger.warning(f"Trace index error: {e}")
+
+    def start(self, job_id, user_id, link):
+        return Trace(job_id, user_id, link)
+
+    def finish(self, trace, state):
+        try:
+            self._queue.put_nowait(trace.document(state))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _write(self, docs):
+        while not self._queue.empty() and len(docs) < self.batch_size:
+            docs.append(self._queue.get_nowait())
+        if self.collection is None:
+            return
+        try:
+            await self.collection.insert_many(docs, ordered=False)
+        except Exception as e:
+            self.dropped += len(docs)
+            logger.error(f"Trace write error: {e}")
+
+    async def flush(self):
+        while not self._queue.empty():
+            await self._write([])
+
+    async def run(self):
+        while True:
+            await self._write([await self._queue.get()])
+
+    async def summary(self, hours=24, slowest=5):
+        """Per phase (count, p50, p95, p99) over the window, and its slowest jobs"""
+        since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        durations = {}
+        async for doc in self.collection.aggregate([
+            {"$match": {"started_at": {"$gte": since}}},
+            {"$unwind": "$spans"},
+            {"$group": {"_id": "$spans.phase", "durations": {"$push": "$spans.duration"}}}
+        ]):
+            durations[doc["_id"]] = sorted(doc["durations"])
+        phases = {
+            phase: (len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99))
+            for phase, values in durations.items()
+        }
+        jobs = await self.collection.find(
+            {"started_at": {"$gte": since}}
+        ).sort("duration", -1).limit(slowest).to_list(length=slowest)
+        return phases, jobs
@@ -0,0 +1,224 @@
+import os
+import copy
+import asyncio
+import hashlib
+import inspect
+import time
+import logging
+from telethon import helpers
+from telethon.errors import FloodWaitError
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.help import GetConfigRequest
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.types import InputFile, InputFileBig
+from metrics import flood_wait
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024  # Largest part Telegram accepts
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Telegram switches to SaveBigFilePart above this
+
+
+class SenderPool:
+    """Extra MTProto connections to the home DC so file parts upload side by side
+
+    Falls back to the client's own connection if the extra senders cannot be set up. Raw
+    senders get no automatic flood sleep, so a FloodWaitError on any of them pauses the
+    whole pool for the requested time and the request is sent again.
+    """
+
+    def __init__(self, client, size=4):
+        self.client = client
+        self.size = size
+        self._senders = []
+        self._next = 0
+        self._lock = asyncio.Lock()
+        self._started = False
+        self._paused_until = 0
+
+    async def _connect(self):
+        # Built from TelegramClient internals as of Telethon 1.45.0, pinned in requirements.txt
+        client = self.client
+        dc = await client._get_dc(client.session.dc_id)
+        sender = MTProtoSender(client.session.auth_key, loggers=client._log)
+        await sender.connect(client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy
+        ))
+        init_request = copy.copy(client._init_request)
+        init_request.query = GetConfigRequest()
+        await sender.send(InvokeWithLayerRequest(LAYER, init_request))
+        return sender
+
+    async def start(self):
+        async with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for _ in range(self.size):
+                try:
+                    self._senders.append(await self._connect())
+                except Exception as e:
+                    logger.warning(f"Could not open extra upload connection: {e}")
+                    break
+            logger.info(f"Upload sender pool ready with {len(self._senders)} extra connections")
+
+    async def __call__(self, request):
+        if not self._started:
+            await self.start()
+        if not self._senders:
+            return await self.client(request)
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            sender = self._senders[self._next % len(self._senders)]
+            self._next += 1
+            try:
+                return await sender.send(request)
+            except FloodWaitError as e:
+                logger.warning(f"Upload flood wait: {e.seconds}s")
+                flood_wait("upload", e.seconds)
+                self._paused_until = max(self._paused_until, time.monotonic() + e.seconds)
+
+    async def close(self):
+        for sender in self._senders:
+            try:
+                await sender.disconnect()
+            except Exception:
+                pass
+        self._senders.clear()
+        self._started = False
+
+
+class StreamingUpload:
+    """Uploads a file to Telegram part by part as its bytes arrive, without touching disk
+
+    Memory stays bounded by max_inflight parts plus one partially filled part.
+    `sender` is anything that can be awaited with a request: the client or a SenderPool.
+    """
+
+    def __init__(self, sender, file_size, file_name, part_size=PART_SIZE, max_inflight=8, retries=3,
+                 progress_callback=None):
+        self.sender = sender
+        self.file_size = file_size
+        self.file_name = file_name
+        self.part_size = part_size
+        self.retries = retries
+        self.file_id = helpers.generate_random_long()
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.part_count = max(1, -(-file_size // part_size))
+        self.uploaded = 0
+        self._md5 = hashlib.md5()
+        self._buffer = bytearray()
+        self._next_part = 0
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks = set()
+        self._error = None
+        self.progress_callback = progress_callback
+
+    def _request(self, index, data):
+        if self.is_big:
+            return SaveBigFilePartRequest(self.file_id, index, self.part_count, data)
+        return SaveFilePartRequest(self.file_id, index, data)
+
+    async def _send(self, index, data):
+        try:
+            attempt = 0
+            while True:
+                try:
+                    if not await self.sender(self._request(index, data)):
+                        raise Exception(f"Telegram refused part {index}")
+                    self.uploaded += len(data)
+                    if self.progress_callback:
+                        result = self.progress_callback(self.uploaded, self.file_size)
+                        if inspect.isawaitable(result):
+                            await result
+                    return
+                except FloodWaitError as e:
+                    # A wait longer than the client's flood_sleep_threshold; not the part's fault
+                    logger.warning(f"Part {index} flood wait: {e.seconds}s")
+                    flood_wait("upload", e.seconds)
+                    await asyncio.sleep(e.seconds)
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    logger.warning(f"Part {index} upload failed (attempt {attempt+1}): {e}")
+                    await asyncio.sleep(1 + attempt)
+                    attempt += 1
+        except Exception as e:
+            self._error = self._error or e
+        finally:
+            self._slots.release()
+
+    async def _submit(self, data):
+        if self._error:
+            raise self._error
+        if self._next_part >= self.part_count:
+            raise Exception(f"Received more than the expected {self.file_size} bytes")
+        if not self.is_big:
+            self._md5.update(data)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._send(self._next_part, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._next_part += 1
+
+    async def feed(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            await self._submit(part)
+
+    async def finish(self):
+        """Flush the last part, wait for every part and return the InputFile to send"""
+        if self._buffer:
+            await self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._error:
+            raise self._error
+        if self._next_part != self.part_count:
+            raise Exception(f"Uploaded {self._next_part} of {self.part_count} parts")
+
+        if self.is_big:
+            return InputFileBig(self.file_id, self.part_count, self.file_name)
+        return InputFile(self.file_id, self.part_count, self.file_name, self._md5.hexdigest())
+
+    def abort(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+
+async def upload_parallel(sender, file_path, file_name=None, part_size=PART_SIZE, parallelism=8,
+                          retries=3, progress_callback=None):
+    """Upload a file from disk with several parts in flight at once; returns the InputFile"""
+    file_size = os.path.getsize(file_path)
+    upload = StreamingUpload(
+        sender,
+        file_size,
+        file_name or os.path.basename(file_path),
+        part_size=part_size,
+        max_inflight=parallelism,
+        retries=retries,
+        progress_callback=progress_callback
+    )
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                part = await asyncio.to_thread(f.read, part_size)
+                if not part:
+                    break
+                await upload.feed(part)
+        return await upload.finish()
+    except BaseException:
+        upload.abort()
+        raise
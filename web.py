@@ -1,5 +1,6 @@
-from flask import Flask
+from flask import Flask, Response
 from threading import Thread
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
 
@@ -7,9 +8,14 @@ app = Flask(__name__)
 def home():
     return "Bot is running"
 
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 def run():
     app.run(host="0.0.0.0", port=8080)
 
 def keep_alive():
-    t = Thread(target=run)
+    # Daemon, so the process exits once the bot has shut down
+    t = Thread(target=run, daemon=True)
     t.start()